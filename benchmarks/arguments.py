@@ -0,0 +1,72 @@
+"""
+Benchmark of ArgumentMatcher.parse_args against ArgumentParserNoExit
+(argparse), on the argument specs of the default commands
+
+Run from the repository root with:
+	python3 benchmarks/arguments.py [number_of_calls]
+
+Prints the time per call of both (default 100 000 calls).
+"""
+import sys
+from os.path import abspath, dirname, join
+from timeit import timeit
+from typing import Callable, List, Tuple, Union
+
+sys.path.insert(0, join(dirname(abspath(__file__)), ".."))
+
+# pylint: disable=wrong-import-position
+from preproc.arguments import ArgumentMatcher
+from preproc.defs import ArgumentParserNoExit
+
+NB_CALLS = 100_000
+
+Parser = Union[ArgumentMatcher, ArgumentParserNoExit]
+
+
+def macro_spec(parser: Parser) -> None:
+	"""arguments of defined macros"""
+	parser.add_argument("vars", nargs="*")
+
+def block_spec(parser: Parser) -> None:
+	"""arguments of the block block"""
+	parser.add_argument("--begin", "-b", nargs="?", default=None)
+	parser.add_argument("--end", "-e", nargs="?", default=None)
+	parser.add_argument("--local-defs", "-d", action="store_true")
+	parser.add_argument("--local-actions", "-a", action="store_true")
+	parser.add_argument("--local-clipboard", "-c", action="store_true")
+	parser.add_argument("--local-labels", "-l", action="store_true")
+
+def replace_spec(parser: Parser) -> None:
+	"""arguments of the replace command"""
+	parser.add_argument("--regex", "-r", action="store_true")
+	parser.add_argument("--ignore-case", "-i", action="store_true")
+	parser.add_argument("--whole-word", "-w", action="store_true")
+	parser.add_argument("--count", "-c", nargs='?', default=0, type=int)
+	parser.add_argument("pattern")
+	parser.add_argument("replacement")
+	parser.add_argument("text", nargs="?", default=None, action="store")
+
+CASES: List[Tuple[str, Callable[[Parser], None], List[str]]] = [
+	("macro", macro_spec, ["1", "some text", "3"]),
+	("block", block_spec, ["-al", "--begin", "(("]),
+	("replace", replace_spec, ["-r", "--count", "2", "a+", "b", "aaa"]),
+]
+
+def main() -> None:
+	"""runs the benchmark"""
+	nb_calls = int(sys.argv[1]) if len(sys.argv) > 1 else NB_CALLS
+	print("{:>10} {:>16} {:>16}".format("spec", "argparse (us)", "matcher (us)"))
+	for name, spec, args in CASES:
+		argparser = ArgumentParserNoExit(prog=name, add_help=False)
+		matcher = ArgumentMatcher(prog=name)
+		spec(argparser)
+		spec(matcher)
+		assert vars(argparser.parse_args(args)) == vars(matcher.parse_args(args))
+		time_argparse = timeit(lambda: argparser.parse_args(args), number=nb_calls)
+		time_matcher = timeit(lambda: matcher.parse_args(args), number=nb_calls)
+		print("{:>10} {:>16.2f} {:>16.2f}".format(
+			name, time_argparse / nb_calls * 1e6, time_matcher / nb_calls * 1e6
+		))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,76 @@
+"""
+Benchmark of Preprocessor._find_tokens against the previous
+implementation (two scans merged with a sort)
+
+Run from the repository root with:
+	python3 benchmarks/find_tokens.py [size_in_megabytes]
+
+Prints the time taken by both on a dense and a sparse document
+(default size 10 MB).
+"""
+import random
+import re
+import sys
+from os.path import abspath, dirname, join
+from timeit import repeat
+
+sys.path.insert(0, join(dirname(abspath(__file__)), ".."))
+
+# pylint: disable=wrong-import-position
+from preproc import Preprocessor
+from preproc.defs import TokenMatch
+from preproc.nodes import TokenList
+
+SIZE = 10
+
+
+def find_tokens_sorted(preprocessor: Preprocessor, string: str) -> TokenList:
+	"""the previous implementation of Preprocessor._find_tokens"""
+	open_tokens  = re.finditer(re.escape(preprocessor.token_begin), string, preprocessor.re_flags)
+	close_tokens = re.finditer(re.escape(preprocessor.token_end), string, preprocessor.re_flags)
+	tokens = [(x.start(), x.end(), TokenMatch.OPEN) for x in open_tokens]
+	tokens += [(x.start(), x.end(), TokenMatch.CLOSE) for x in close_tokens]
+	tokens.sort(key=lambda x: x[0] + 0.5 * int(x[2]))
+	return tokens
+
+def make_document(size: int, words: list) -> str:
+	"""a random document of size characters made of words"""
+	generator = random.Random(size)
+	pieces = []
+	length = 0
+	while length < size:
+		word = generator.choice(words)
+		pieces.append(word)
+		length += len(word)
+	return "".join(pieces)[:size]
+
+def main() -> None:
+	"""runs the benchmark"""
+	size = int(float(sys.argv[1]) * 1_000_000) if len(sys.argv) > 1 else SIZE * 1_000_000
+	documents = {
+		"dense": make_document(size, [
+			"lorem ipsum ", "{% foo %}", "{% if def x %}", "{% endif %}", "dolor\n",
+		]),
+		"sparse": make_document(size, [
+			"lorem ipsum dolor sit amet, consectetur adipiscing elit " * 4,
+			"{% foo %}", "{% if def x %}", "{% endif %}", "sed do eiusmod\n",
+		]),
+		"overlapping": make_document(size, [
+			"lorem ipsum ", "{% foo %}", "{%}", "dolor\n",
+		]),
+	}
+	preprocessor = Preprocessor()
+	print("{:>12} {:>10} {:>12} {:>12}".format("document", "tokens", "sorted (s)", "single (s)"))
+	for name, document in documents.items():
+		tokens = preprocessor._find_tokens(document)
+		assert tokens == find_tokens_sorted(preprocessor, document)
+		nb_tokens = len(tokens)
+		del tokens
+		time_sorted = min(repeat(lambda: find_tokens_sorted(preprocessor, document), number=1, repeat=3))
+		time_single = min(repeat(lambda: preprocessor._find_tokens(document), number=1, repeat=3))
+		print("{:>12} {:>10} {:>12.3f} {:>12.3f}".format(
+			name, nb_tokens, time_sorted, time_single
+		))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,97 @@
+"""
+Benchmark of LabelStack.dilate_level against the previous
+implementation (rebuilding every list of the level)
+
+Run from the repository root with:
+	python3 benchmarks/labels.py [number_of_labels] [number_of_replacements]
+
+Adds the labels to a level, then dilates it once per replacement
+(default 10 000 labels and 100 000 replacements), either after all labels
+(as when parsing from left to right) or at random positions.
+The previous implementation only runs on a sample of the replacements,
+the time per replacement is printed for both.
+"""
+import random
+import sys
+from os.path import abspath, dirname, join
+from timeit import default_timer
+from typing import Dict, List, Tuple
+
+sys.path.insert(0, join(dirname(abspath(__file__)), ".."))
+
+# pylint: disable=wrong-import-position
+from preproc.labels import LabelStack
+
+NB_LABELS = 10_000
+NB_REPLACEMENTS = 100_000
+OLD_SAMPLE = 1_000
+
+Replacements = List[Tuple[int, int]]
+
+
+def dilate_rebuild(level: Dict[str, List[int]], pos: int, value: int) -> Dict[str, List[int]]:
+	"""the previous implementation of LabelStack.dilate_level"""
+	return {
+		label: [x + value if x > pos else x for x in positions]
+		for label, positions in level.items()
+	}
+
+def make_labels(nb_labels: int) -> Tuple[Dict[str, List[int]], int]:
+	"""nb_labels positions spread between 50 labels, and the document size"""
+	generator = random.Random(nb_labels)
+	labels = dict() # type: Dict[str, List[int]]
+	position = 0
+	for _ in range(nb_labels):
+		position += generator.randint(1, 100)
+		labels.setdefault("label_{}".format(generator.randrange(50)), []).append(position)
+	return labels, position
+
+def make_replacements(nb_replacements: int, start: int, end: int) -> Replacements:
+	"""replacements between start and end, each inserting or deleting a few characters"""
+	generator = random.Random(nb_replacements)
+	return [
+		(generator.randint(start, end), generator.randint(-5, 20))
+		for _ in range(nb_replacements)
+	]
+
+def time_new(labels: Dict[str, List[int]], replacements: Replacements) -> float:
+	"""time per replacement of the current implementation"""
+	stack = LabelStack()
+	stack.new_level()
+	for label, positions in labels.items():
+		for position in positions:
+			stack.add_label(label, position)
+	start = default_timer()
+	for pos, value in replacements:
+		stack.dilate_level(0, pos, value)
+	return (default_timer() - start) / len(replacements)
+
+def time_old(labels: Dict[str, List[int]], replacements: Replacements) -> float:
+	"""time per replacement of the previous implementation"""
+	level = labels
+	start = default_timer()
+	for pos, value in replacements:
+		level = dilate_rebuild(level, pos, value)
+	return (default_timer() - start) / len(replacements)
+
+def main() -> None:
+	"""runs the benchmark"""
+	nb_labels = int(sys.argv[1]) if len(sys.argv) > 1 else NB_LABELS
+	nb_replacements = int(sys.argv[2]) if len(sys.argv) > 2 else NB_REPLACEMENTS
+	labels, size = make_labels(nb_labels)
+	workloads = {
+		"after labels": make_replacements(nb_replacements, size, 2 * size),
+		"random": make_replacements(nb_replacements, 0, size),
+	}
+	print("{:>14} {:>14} {:>18} {:>18}".format(
+		"replacements", "new total (s)", "new per repl. (us)", "old per repl. (us)"
+	))
+	for name, replacements in workloads.items():
+		new = time_new(labels, replacements)
+		old = time_old(labels, replacements[:OLD_SAMPLE])
+		print("{:>14} {:>14.3f} {:>18.2f} {:>18.2f}".format(
+			name, new * len(replacements), new * 1e6, old * 1e6
+		))
+
+if __name__ == "__main__":
+	main()
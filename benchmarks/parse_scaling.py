@@ -0,0 +1,47 @@
+"""
+Benchmark of Preprocessor.compile and Preprocessor.process
+on documents with many commands
+
+Run from the repository root with:
+	python3 benchmarks/parse_scaling.py [number_of_commands...]
+
+Prints the time per command, which should stay roughly constant
+as the number of commands grows.
+"""
+import sys
+from os.path import abspath, dirname, join
+from timeit import timeit
+
+sys.path.insert(0, join(dirname(abspath(__file__)), ".."))
+
+from preproc import Preprocessor  # pylint: disable=wrong-import-position
+
+SIZES = (10_000, 20_000, 50_000, 100_000)
+
+
+def make_document(nb_commands: int) -> str:
+	"""a generated config with nb_commands commands, one in ten being a block"""
+	lines = ["{% def value 42 %}"]
+	for i in range(nb_commands // 10):
+		lines.extend(
+			"key_{}_{} = {{% value %}}".format(i, j) for j in range(8)
+		)
+		lines.append("{{% if def value %}}section {}{{% endif %}}".format(i))
+	return "\n".join(lines)
+
+def main() -> None:
+	"""runs the benchmark"""
+	sizes = [int(arg) for arg in sys.argv[1:]] or SIZES
+	print("{:>10} {:>12} {:>12} {:>16}".format(
+		"commands", "compile (s)", "process (s)", "per command (us)"
+	))
+	for nb_commands in sizes:
+		document = make_document(nb_commands)
+		compile_time = timeit(lambda: Preprocessor().compile(document), number=1)
+		process_time = timeit(lambda: Preprocessor().process(document, "benchmark"), number=1)
+		print("{:>10} {:>12.3f} {:>12.3f} {:>16.2f}".format(
+			nb_commands, compile_time, process_time, 1e6 * process_time / nb_commands
+		))
+
+if __name__ == "__main__":
+	main()
@@ -4,12 +4,13 @@ and when run as main, executes the preprocessor using arguments from sys.argv
 """
 
 import argparse
+import json
 from os.path import abspath, dirname
 from pathlib import Path
 from sys import stderr, stdin, stdout
-from typing import List, Optional
+from typing import Dict, List, Optional
 
-from .defaults import Preprocessor, define_macro
+from .defaults import Preprocessor
 from .defs import PREPROCESSOR_NAME, PREPROCESSOR_VERSION
 from .errors import ErrorMode, WarningMode
 
@@ -21,6 +22,7 @@ parser.add_argument("--version", "-v", action="store_true")
 parser.add_argument("--output", "-o", nargs="?", type=Path, default=stdout)
 parser.add_argument("--help", "-h", nargs="?", const="", default=None)
 parser.add_argument("--define", "-d", "-D", nargs="?", action="append", default=[])
+parser.add_argument("--define-file", nargs=1, action="append", default=[], type=Path)
 parser.add_argument(
 	"--include", "-i", "-I", nargs=1, action="append", default=[], type=abspath# type: ignore
 )
@@ -34,6 +36,7 @@ def process_defines(preproc: Preprocessor, defines: List[str]) -> None:
 	"""process command line defines
 	defines should be a list of strings like "<ident>" or "<ident>=<value>"
 	"""
+	mapping: Dict[str, str] = dict()
 	for define in defines:
 		if isinstance(define, list):
 			define = define[0] # argparse creates nested list for some reason
@@ -49,7 +52,49 @@ def process_defines(preproc: Preprocessor, defines: List[str]) -> None:
 				name
 			))
 			exit(1)
-		define_macro(preproc, name, [], value)
+		mapping[name] = value
+	preproc.define_many(mapping)
+
+def read_define_file(path: Path) -> List[str]:
+	"""reads a file of defines, either:
+	- a JSON object {"<ident>": <value>, ...}, non-string values are
+	  defined as their JSON representation
+	- lines "<ident>" or "<ident>=<value>" (both stripped), empty lines and
+	  lines starting with # are ignored
+	returns a list of "<ident>=<value>" strings, for process_defines"""
+	try:
+		with open(path, "r") as file:
+			contents = file.read()
+	except FileNotFoundError:
+		parser.error("argument --define-file: file not found \"{}\"".format(path))
+	except PermissionError:
+		parser.error("argument --define-file: permission denied \"{}\"".format(path))
+	except (OSError, UnicodeDecodeError):
+		parser.error("argument --define-file: can't read file \"{}\"".format(path))
+	defines = []
+	if contents.lstrip().startswith("{"):
+		try:
+			mapping = json.loads(contents)
+		except ValueError as error:
+			parser.error("argument --define-file: invalid JSON in \"{}\": {}".format(path, error))
+		if not isinstance(mapping, dict):
+			parser.error("argument --define-file: \"{}\" should contain a JSON object".format(path))
+		for name, value in mapping.items():
+			if not isinstance(value, str):
+				value = json.dumps(value)
+			defines.append((name, value))
+	else:
+		for line in contents.splitlines():
+			if not line.strip() or line.lstrip().startswith("#"):
+				continue
+			name, _, value = line.partition("=")
+			defines.append((name.strip(), value.strip()))
+	for name, _ in defines:
+		if not name.isidentifier():
+			parser.error("argument --define-file: invalid define name \"{}\" in \"{}\"".format(
+				name, path
+			))
+	return ["{}={}".format(name, value) for name, value in defines]
 
 def process_options(preproc: Preprocessor, arguments: argparse.Namespace) -> None:
 	"""process the preprocessor options
@@ -64,8 +109,11 @@ def process_options(preproc: Preprocessor, arguments: argparse.Namespace) -> Non
 	command.doc = "Prints name of output file" # type: ignore
 	preproc.commands["output_name"] = command
 
-	# adding defined commands
-	process_defines(preproc, arguments.define)
+	# adding defined commands, those on the command line override define files
+	defines = []
+	for path in arguments.define_file:
+		defines.extend(read_define_file(path[0]))
+	process_defines(preproc, defines + arguments.define)
 
 	# include path
 	preproc.include_path = [
@@ -0,0 +1,426 @@
+"""
+This module contains a lightweight replacement for argparse,
+used to parse command arguments (the output of Preprocessor.split_args)
+
+It contains:
+
+- class ArgumentMatcher
+	declared like an ArgumentParserNoExit (with add_argument),
+	parse_args returns the same argparse.Namespace and raises
+	argparse.ArgumentError on the same inputs.
+	Only supports the features commands need:
+	- actions "store", "store_true", "store_false", "store_const" and "append"
+	- nargs None, "?", "*", "+" or an integer
+	- type, default, const, choices, required and dest
+	The option tables and patterns are built once, so parsing
+	is much cheaper than argparse's
+"""
+import argparse
+import re
+from bisect import bisect_left
+from typing import Any, Callable, Dict, List, Optional, Pattern, Tuple, Union
+
+Nargs = Union[None, int, str]
+
+
+class _Argument:
+	"""an argument of an ArgumentMatcher"""
+
+	option_strings: List[str]
+	dest: str
+	action: str
+	nargs: Nargs
+	const: Any
+	default: Any
+	type: Optional[Callable[[str], Any]]
+	choices: Any
+	required: bool
+	pattern: str
+	regex: Pattern[str]
+
+	def __init__(self: "_Argument", option_strings: List[str], dest: str, action: str,
+		nargs: Nargs, const: Any, default: Any, type: Optional[Callable[[str], Any]],
+		choices: Any, required: bool
+	) -> None:
+		self.option_strings = option_strings
+		self.dest = dest
+		self.action = action
+		self.nargs = nargs
+		self.const = const
+		self.default = default
+		self.type = type
+		self.choices = choices
+		self.required = required
+		# regex matching the argument's values in a pattern of
+		# "A" (argument), "O" (option) and "-" ("--")
+		if nargs is None:
+			pattern = "(-*A-*)"
+		elif nargs == "?":
+			pattern = "(-*A?-*)"
+		elif nargs == "*":
+			pattern = "(-*[A-]*)"
+		elif nargs == "+":
+			pattern = "(-*A[A-]*)"
+		elif isinstance(nargs, int):
+			pattern = "(-*{}-*)".format("-*".join("A" * nargs))
+		else:
+			raise ValueError("invalid nargs value {}".format(nargs))
+		if option_strings:
+			# options can't take "--"
+			pattern = pattern.replace("-*", "").replace("-", "")
+		self.pattern = pattern
+		self.regex = re.compile(pattern)
+
+	@property
+	def name(self: "_Argument") -> str:
+		"""name used in error messages"""
+		if self.option_strings:
+			return "/".join(self.option_strings)
+		return self.dest
+
+	def error(self: "_Argument", message: str) -> argparse.ArgumentError:
+		"""an error relative to this argument"""
+		return argparse.ArgumentError(None, "argument {}: {}".format(self.name, message))
+
+
+# an option found in the arguments: (argument, option string, explicit value)
+OptionMatch = Tuple[Optional[_Argument], str, Optional[str]]
+
+REGEX_NEGATIVE_NUMBER = re.compile(r"^-\d+$|^-\d*\.\d+$")
+
+
+class ArgumentMatcher:
+	"""a precompiled argument parser, drop-in replacement for
+	ArgumentParserNoExit on the supported subset of argparse
+	usage:
+	  parser = ArgumentMatcher(prog="my_command")
+	  parser.add_argument("--verbose", "-v", action="store_true")
+	  parser.add_argument("file")
+	  arguments = parser.parse_args(preprocessor.split_args(args))
+	  # raises argparse.ArgumentError on invalid arguments
+	"""
+
+	prog: str
+	_arguments: List[_Argument]
+	_positionals: List[_Argument]
+	_options: Dict[str, _Argument]
+	_negative_number_options: bool
+	_defaults: Dict[str, Any]
+	_patterns: Dict[Tuple[int, int], Pattern[str]]
+	_matches: Dict[Tuple[int, str], List[int]]
+	_option_matches: Dict[str, Optional[OptionMatch]]
+
+	ACTIONS = ("store", "store_true", "store_false", "store_const", "append")
+
+	def __init__(self: "ArgumentMatcher", prog: str = "", **_: Any) -> None:
+		"""initializes an empty matcher,
+		other keywords arguments of ArgumentParser (description...) are ignored"""
+		self.prog = prog
+		self._arguments = []
+		self._positionals = []
+		self._options = dict()
+		self._negative_number_options = False
+		self._defaults = dict()
+		self._patterns = dict()
+		self._matches = dict()
+		self._option_matches = dict()
+
+	def add_argument(self: "ArgumentMatcher", *names: str,
+		action: str = "store", nargs: Nargs = None, const: Any = None,
+		default: Any = None, type: Optional[Callable[[str], Any]] = None,
+		choices: Any = None, required: Optional[bool] = None, dest: Optional[str] = None
+	) -> None:
+		"""adds an argument, same as ArgumentParser.add_argument"""
+		if action not in self.ACTIONS:
+			raise ValueError("unsupported action {}".format(action))
+		if action in ("store_true", "store_false", "store_const"):
+			nargs = 0
+			if action == "store_true":
+				const = True
+				default = False if default is None else default
+			elif action == "store_false":
+				const = False
+				default = True if default is None else default
+		option_strings = [name for name in names if name.startswith("-")]
+		if option_strings:
+			if dest is None:
+				long_options = [name for name in option_strings if name.startswith("--")]
+				dest = (long_options or option_strings)[0].lstrip("-").replace("-", "_")
+			if required is None:
+				required = False
+		else:
+			if len(names) != 1:
+				raise ValueError("positional arguments should have a single name")
+			dest = names[0]
+			required = nargs not in ("?", "*")
+		argument = _Argument(option_strings, dest, action, nargs, const, default, type, choices, required)
+		self._arguments.append(argument)
+		self._defaults[dest] = default
+		if option_strings:
+			for option in option_strings:
+				self._options[option] = argument
+				if REGEX_NEGATIVE_NUMBER.match(option):
+					self._negative_number_options = True
+		else:
+			self._positionals.append(argument)
+		self._patterns.clear()
+		self._matches.clear()
+		self._option_matches.clear()
+
+	def _match_option(self: "ArgumentMatcher", arg: str) -> Optional[OptionMatch]:
+		"""returns None if arg is a positional argument
+		else (argument, option_string, explicit_value)"""
+		if not arg or arg[0] != "-":
+			return None
+		if arg in self._options:
+			return self._options[arg], arg, None
+		if len(arg) == 1:
+			return None
+		value: Optional[str]
+		if "=" in arg:
+			option, value = arg.split("=", 1)
+			if option in self._options:
+				return self._options[option], option, value
+		matches = [] # type: List[OptionMatch]
+		if arg[1] == "-":
+			# abbreviated long option
+			prefix, value = arg.split("=", 1) if "=" in arg else (arg, None)
+			matches = [
+				(argument, option, value) for option, argument in self._options.items()
+				if option.startswith(prefix)
+			]
+		else:
+			# short option followed by its value
+			for option, argument in self._options.items():
+				if option == arg[:2]:
+					matches.append((argument, option, arg[2:]))
+				elif option.startswith(arg):
+					matches.append((argument, option, None))
+		if len(matches) > 1:
+			raise argparse.ArgumentError(None, "ambiguous option: {} could match {}".format(
+				arg, ", ".join(option for _, option, _ in matches)
+			))
+		if matches:
+			return matches[0]
+		if REGEX_NEGATIVE_NUMBER.match(arg) and not self._negative_number_options:
+			return None
+		if " " in arg:
+			return None
+		return None, arg, None
+
+	def _pattern(self: "ArgumentMatcher", start: int, stop: int) -> Pattern[str]:
+		"""compiled pattern matching positionals[start:stop]"""
+		key = (start, stop)
+		if key not in self._patterns:
+			self._patterns[key] = re.compile(
+				"".join(argument.pattern for argument in self._positionals[start:stop])
+			)
+		return self._patterns[key]
+
+	@staticmethod
+	def _convert(argument: _Argument, string: str) -> Any:
+		"""applies argument.type to string"""
+		if argument.type is None:
+			return string
+		try:
+			return argument.type(string)
+		except argparse.ArgumentTypeError as error:
+			raise argument.error(str(error))
+		except (TypeError, ValueError):
+			name = getattr(argument.type, "__name__", repr(argument.type))
+			raise argument.error("invalid {} value: {!r}".format(name, string))
+
+	@staticmethod
+	def _check(argument: _Argument, value: Any) -> None:
+		"""checks value is one of argument.choices"""
+		if argument.choices is not None and value not in argument.choices:
+			raise argument.error("invalid choice: {!r} (choose from {})".format(
+				value, ", ".join(map(repr, argument.choices))
+			))
+
+	def _values(self: "ArgumentMatcher", argument: _Argument, strings: List[str]) -> Any:
+		"""converts the strings matched by argument into its value"""
+		if "--" in strings:
+			strings.remove("--")
+		if not strings and argument.nargs == "?":
+			value = argument.const if argument.option_strings else argument.default
+			if isinstance(value, str):
+				value = self._convert(argument, value)
+				self._check(argument, value)
+		elif not strings and argument.nargs == "*" and not argument.option_strings:
+			value = strings if argument.default is None else argument.default
+			self._check(argument, value)
+		elif len(strings) == 1 and argument.nargs in (None, "?"):
+			value = self._convert(argument, strings[0])
+			self._check(argument, value)
+		elif argument.type is None and argument.choices is None:
+			value = strings
+		else:
+			value = [self._convert(argument, string) for string in strings]
+			for val in value:
+				self._check(argument, val)
+		return value
+
+	def _take(self: "ArgumentMatcher",
+		namespace: argparse.Namespace, argument: _Argument, strings: List[str]
+	) -> None:
+		"""applies an argument to the namespace"""
+		value = self._values(argument, strings)
+		if argument.action == "store":
+			setattr(namespace, argument.dest, value)
+		elif argument.action == "append":
+			items = getattr(namespace, argument.dest, None)
+			items = [] if items is None else list(items)
+			items.append(value)
+			setattr(namespace, argument.dest, items)
+		else:
+			setattr(namespace, argument.dest, argument.const)
+
+	def _match_positionals(self: "ArgumentMatcher", positional: int, pattern: str) -> List[int]:
+		"""number of values taken by each of the positionals from positional on,
+		stops at the first positional that doesn't match the start of pattern"""
+		# positionals never match options, so only the pattern up to the first one matters
+		end = pattern.find("O")
+		if end != -1:
+			pattern = pattern[:end]
+		key = (positional, pattern)
+		if key not in self._matches:
+			if len(self._matches) >= 256:
+				self._matches.clear()
+			counts = [] # type: List[int]
+			for stop in range(len(self._positionals), positional, -1):
+				match = self._pattern(positional, stop).match(pattern)
+				if match is not None:
+					counts = [len(group) for group in match.groups()]
+					break
+			self._matches[key] = counts
+		return self._matches[key]
+
+	def parse_args(self: "ArgumentMatcher", args: List[str]) -> argparse.Namespace:
+		"""parses a list of arguments, as ArgumentParser.parse_args
+		raises argparse.ArgumentError if they are invalid"""
+		namespace = argparse.Namespace(**self._defaults)
+
+		# classify arguments: "O" for options, "A" for values, "-" for "--"
+		options = dict() # type: Dict[int, OptionMatch]
+		pattern_parts = []
+		for i, arg in enumerate(args):
+			if arg[:1] != "-":
+				pattern_parts.append("A")
+				continue
+			if arg == "--":
+				pattern_parts.append("-")
+				pattern_parts.extend("A" * (len(args) - i - 1))
+				break
+			if arg in self._option_matches:
+				option = self._option_matches[arg]
+			else:
+				option = self._match_option(arg)
+				if len(self._option_matches) >= 256:
+					self._option_matches.clear()
+				self._option_matches[arg] = option
+			if option is None:
+				pattern_parts.append("A")
+			else:
+				options[i] = option
+				pattern_parts.append("O")
+		pattern = "".join(pattern_parts)
+
+		seen = set() # ids of arguments found
+		extras = [] # type: List[str]
+		positional = 0 # index of the first positional left
+
+		def consume_positionals(index: int) -> int:
+			"""matches as many positionals as possible from index"""
+			nonlocal positional
+			for count in self._match_positionals(positional, pattern[index:]):
+				argument = self._positionals[positional]
+				seen.add(id(argument))
+				self._take(namespace, argument, args[index:index + count])
+				index += count
+				positional += 1
+			return index
+
+		def consume_option(index: int) -> int:
+			"""consumes the option at index and its values"""
+			argument, option, value = options[index]
+			taken = [] # type: List[Tuple[_Argument, List[str]]]
+			while True:
+				if argument is None:
+					extras.append(args[index])
+					return index + 1
+				if value is not None:
+					nb_args = self._match_count(argument, "A")
+					if nb_args == 0 and option[1] != "-" and value != "":
+						# -xyz is -x -y -z
+						taken.append((argument, []))
+						option = "-" + value[0]
+						if option not in self._options:
+							raise argument.error("ignored explicit argument {!r}".format(value))
+						argument = self._options[option]
+						value = value[1:] or None
+					elif nb_args == 1:
+						stop = index + 1
+						taken.append((argument, [value]))
+						break
+					else:
+						raise argument.error("ignored explicit argument {!r}".format(value))
+				else:
+					start = index + 1
+					stop = start + self._match_count(argument, pattern[start:])
+					taken.append((argument, args[start:stop]))
+					break
+			for argument, strings in taken:
+				seen.add(id(argument))
+				self._take(namespace, argument, strings)
+			return stop
+
+		# alternate positionals and options until the last option
+		index = 0
+		option_indices = list(options) # sorted by construction
+		last_option = option_indices[-1] if option_indices else -1
+		while index <= last_option:
+			next_option = option_indices[bisect_left(option_indices, index)]
+			if index != next_option:
+				end = consume_positionals(index)
+				if end > index:
+					index = end
+					continue
+				extras.extend(args[index:next_option])
+				index = next_option
+			index = consume_option(index)
+		index = consume_positionals(index)
+		extras.extend(args[index:])
+
+		required = []
+		for argument in self._arguments:
+			if id(argument) not in seen:
+				if argument.required:
+					required.append(argument.name)
+				elif isinstance(argument.default, str) and argument.type is not None:
+					setattr(namespace, argument.dest, self._convert(argument, argument.default))
+		if required:
+			raise argparse.ArgumentError(None,
+				"the following arguments are required: {}".format(", ".join(required))
+			)
+		if extras:
+			raise argparse.ArgumentError(None,
+				"unrecognized arguments: {}".format(" ".join(extras))
+			)
+		return namespace
+
+	@staticmethod
+	def _match_count(argument: _Argument, pattern: str) -> int:
+		"""number of values taken by an option at the start of pattern"""
+		match = argument.regex.match(pattern)
+		if match is None:
+			messages = {
+				None: "expected one argument",
+				"?": "expected at most one argument",
+				"+": "expected at least one argument",
+			}
+			message = messages.get(argument.nargs) # type: ignore
+			if message is None:
+				message = "expected {} argument{}".format(argument.nargs, "" if argument.nargs == 1 else "s")
+			raise argument.error(message)
+		return len(match.group(1))
@@ -2,13 +2,24 @@
 Definitions of default preprocessor blocks
 """
 import argparse
+import csv
+import json
 import re
-from typing import Iterable, Optional, Tuple
-
+from itertools import chain, islice
+from multiprocessing import (cpu_count, current_process, get_all_start_methods,
+                             get_context)
+from os.path import splitext
+from typing import (Any, Dict, Iterable, Iterator, List, Optional, TextIO,
+                    Tuple)
+
+from .arguments import ArgumentMatcher
 from .conditions import condition_eval, find_matching_close_parenthese
 from .defs import (REGEX_IDENTIFIER, REGEX_IDENTIFIER_END, REGEX_INTEGER,
-                   ArgumentParserNoExit, TokenMatch, to_integer)
-from .preprocessor import Preprocessor
+                   TokenMatch, to_integer)
+from .errors import ErrorMode, WarningMode
+from .nodes import Tree
+from .preprocessor import Preprocessor, TypeCommand
+from .registry import version_mark
 
 # ============================================================
 # simple blocks (void, block, verbatim)
@@ -29,7 +40,7 @@ blck_void.doc = ( # type: ignore
 	Use it to place comments or a bunch of def
 	without adding whitespace""")
 
-block_parser = ArgumentParserNoExit(prog="block", add_help=False)
+block_parser = ArgumentMatcher(prog="block")
 block_parser.add_argument("--begin", "-b", nargs="?", default=None)
 block_parser.add_argument("--end", "-e", nargs="?", default=None)
 block_parser.add_argument("--local-defs", "-d", action="store_true")
@@ -86,6 +97,7 @@ def blck_block(preprocessor: Preprocessor, args: str, contents: str) -> str:
 		preprocessor.commands = commands
 		preprocessor.blocks = blocks
 		preprocessor.command_vars["def"] = defs
+		preprocessor.definitions_changed()
 	if arguments.local_clipboard:
 		preprocessor.command_vars["clipboard"] = clipboard
 
@@ -120,6 +132,7 @@ blck_block.doc = ( # type: ignore
 	    {% endblock %} // this endblock is ignored
 	  {% endblock %} // block ends here
 	""")
+blck_void.pure = True # type: ignore
 
 def blck_verbatim(preprocessor: Preprocessor, args: str, contents: str) -> str:
 	"""The verbatim block. It copies its content without parsing them
@@ -143,6 +156,7 @@ blck_verbatim.doc = ( # type: ignore
 	Prints:
 	  "some text with {% verbatim %}nested verbatim{% endverbatim %}"
 	""")
+blck_verbatim.pure = True # type: ignore
 
 def blck_repeat(preprocessor: Preprocessor, args: str, contents: str) -> str:
 	"""The repeat block.
@@ -170,6 +184,7 @@ blck_repeat.doc = ( # type: ignore
 	Unlike {% for x in range(3) %}, {% repeat 3 %} only
 	  renders the block once and prints three copies.
 	""")
+blck_repeat.pure = True # type: ignore
 
 
 # ============================================================
@@ -229,22 +244,27 @@ blck_atlabel.doc = ( # type: ignore
 def fnl_atlabel(preprocessor: Preprocessor, string: str) -> str:
 	"""places atlabel blocks at all matching labels"""
 	if "atlabel" in preprocessor.command_vars:
-		deletions = []
-		for lbl in preprocessor.command_vars["atlabel"]:
-			nb_labels = len(preprocessor.labels.get_label(lbl))
-			if nb_labels == 0:
+		insertions: List[Tuple[int, int, str]] = []
+		for rank, lbl in enumerate(preprocessor.command_vars["atlabel"]):
+			positions = preprocessor.labels.get_label(lbl)
+			if not positions:
 				preprocessor.send_warning("unplaced-atlabel",
 					'No matching label for atlabel block "{}"'.format(lbl)
 				)
-			for i in range(nb_labels):
-				# use references to labels because of offsets
-				index = preprocessor.labels.get_label(lbl)[i]
-				string = preprocessor.replace_string(
-					index, index, string, preprocessor.command_vars["atlabel"][lbl], []
-				)
-			deletions.append(lbl)
-		for lbl in deletions:
-			del preprocessor.command_vars["atlabel"][lbl]
+			text = preprocessor.command_vars["atlabel"][lbl]
+			# blocks of later atlabels go first when at the same label
+			insertions.extend((index, -rank, text) for index in positions)
+		preprocessor.command_vars["atlabel"].clear()
+		insertions.sort()
+		pieces = []
+		last = 0
+		for index, _, text in insertions:
+			pieces.append(string[last:index])
+			pieces.append(text)
+			last = index
+		pieces.append(string[last:])
+		preprocessor._dilate_many([(index, index, len(text)) for index, _, text in insertions])
+		string = "".join(pieces)
 	return string
 
 
@@ -253,26 +273,237 @@ def fnl_atlabel(preprocessor: Preprocessor, string: str) -> str:
 # ============================================================
 
 
+# fields bound by a for loop iteration, one (value, named fields) per loop variable
+# named fields are None when the value can't be indexed (range, lists, plain lines)
+Record = List[Tuple[str, Optional[Dict[str, str]]]]
+
+REGEX_FOR_FILE = r"file\(\s*(?:\"([^\"]*)\"|'([^']*)'|([^\s)]*))\s*\)\s*$"
+REGEX_FOR_ZIP = r"zip\(\s*({0}(?:\s*,\s*{0})*)\s*\)\s*$".format(REGEX_IDENTIFIER)
+
+def json_field(value: Any) -> str:
+	"""strings are used as is, other json values are dumped"""
+	if isinstance(value, str):
+		return value
+	return json.dumps(value)
+
+def read_records(preprocessor: Preprocessor, name: str, nb_fields: int) -> Iterator[Record]:
+	"""lazily reads the file name (resolved with preprocessor.find_file)
+	yields one record per row:
+	- .csv files: one row per line, the first line is the header naming the fields
+	- .jsonl/.ndjson files: one json value per non-empty line,
+	  objects are indexed by key and arrays by position
+	- other files: one value per line
+	with nb_fields == 1, the record is the whole row with its named fields
+	else it contains the nb_fields fields of the row, in order"""
+	filepath = preprocessor.find_file(name)
+	if filepath is None:
+		preprocessor.send_error("file-error", 'file not found "{}"'.format(name))
+		return
+	extension = splitext(filepath)[1].lower()
+	try:
+		with open(filepath, "r", newline="") as file:
+			rows: Iterator[Tuple[str, List[str], Optional[Dict[str, str]]]]
+			if extension == ".csv":
+				rows = csv_rows(file)
+			elif extension in (".jsonl", ".ndjson"):
+				rows = json_rows(preprocessor, name, file)
+			else:
+				rows = ((line.rstrip("\r\n"), [line.rstrip("\r\n")], None) for line in file)
+			for line, (text, fields, named) in enumerate(rows, start=1):
+				if nb_fields == 1:
+					yield [(text, named)]
+				elif len(fields) == nb_fields:
+					yield [(field, None) for field in fields]
+				else:
+					preprocessor.send_error("invalid-argument",
+						'row {} of "{}" has {} fields, expected {} (one per loop variable)'.format(
+							line, name, len(fields), nb_fields)
+					)
+	except PermissionError:
+		preprocessor.send_error("file-error", 'can\'t open file "{}", permission denied'.format(name))
+	except (OSError, UnicodeDecodeError, csv.Error):
+		preprocessor.send_error("file-error", 'can\'t read file "{}"'.format(name))
+
+def csv_rows(file: TextIO) -> Iterator[Tuple[str, List[str], Optional[Dict[str, str]]]]:
+	"""rows of a csv file, fields are named by the header"""
+	reader = csv.reader(file)
+	header = next(reader, [])
+	for row in reader:
+		yield ",".join(row), row, dict(zip(header, row))
+
+def json_rows(preprocessor: Preprocessor, name: str, file: TextIO
+) -> Iterator[Tuple[str, List[str], Optional[Dict[str, str]]]]:
+	"""rows of a json lines file, skips empty lines"""
+	for nb, line in enumerate(file, start=1):
+		line = line.strip()
+		if line == "":
+			continue
+		try:
+			value = json.loads(line)
+		except ValueError:
+			preprocessor.send_error("file-error", 'invalid json on line {} of "{}"'.format(nb, name))
+		if isinstance(value, dict):
+			named = {key: json_field(field) for key, field in value.items()}
+			yield line, list(named.values()), named
+		elif isinstance(value, list):
+			fields = [json_field(field) for field in value]
+			yield line, fields, {str(i): field for i, field in enumerate(fields)}
+		else:
+			yield line, [json_field(value)], None
+
+def zip_records(preprocessor: Preprocessor, names: List[str], nb_idents: int) -> Iterator[Record]:
+	"""records of zip(names), with names lists defined by deflist
+	stops at the end of the shortest list"""
+	if len(names) != nb_idents:
+		preprocessor.send_error("invalid-argument",
+			"Invalid syntax.\nzip needs one loop variable per list, got {} lists and {} variables".format(
+				len(names), nb_idents)
+		)
+	lists = []
+	for name in names:
+		command = preprocessor.commands.get(name)
+		if not hasattr(command, "list"):
+			preprocessor.send_error("invalid-argument",
+				"invalid argument.\nzip arguments should be lists defined with deflist, got \"{}\"".format(name)
+			)
+		lists.append(command.list) # type: ignore
+	return ([(value, None) for value in values] for values in zip(*lists))
+
+def loop_command(ident: str, slot: List[Any]) -> TypeCommand:
+	"""command defined by a for loop
+	returns slot[0], or the field named by its argument in slot[1]"""
+	def defined_value(preproc: Preprocessor, args: str) -> str:
+		"""new command defined in for block"""
+		field = args.strip()
+		if field != "":
+			if slot[1] is not None:
+				if field not in slot[1]:
+					preproc.send_error("invalid-argument",
+						'no field "{}" in {} = \'{}\''.format(field, ident, slot[0])
+					)
+				return slot[1][field]
+			preproc.send_warning("extra-arguments",
+				"Extra arguments.\nThe command {} defined in for loop takes no arguments".format(ident)
+			)
+		return slot[0]
+	defined_value.__name__ = "for_cmd_{}".format(ident)
+	# not pure as the value changes, but each change touches ident in preprocessor.commands
+	defined_value.side_effects = False # type: ignore
+	return defined_value
+
+def bind_record(preprocessor: Preprocessor, idents: List[str], slots: List[List[Any]],
+                commands: List[TypeCommand], record: Record) -> None:
+	"""sets the values returned by the loop commands and (re)defines them"""
+	for ident, slot, command, (value, fields) in zip(idents, slots, commands, record):
+		slot[0] = value
+		slot[1] = fields
+		if preprocessor.commands.get(ident) is command:
+			preprocessor.commands.touch(ident)
+		else:
+			preprocessor.commands[ident] = command
+
+# loop rendered by the workers of a for --parallel: (preprocessor, idents, slots, commands, tree, checkpoint)
+# set while the pool is created, the forked workers inherit it
+_parallel_loop: Optional[Tuple[Preprocessor, List[str], List[List[Any]], List[TypeCommand], Tree, Any]] = None
+
+# number of iterations sent to a worker at once
+PARALLEL_CHUNK_SIZE = 64
+
+def init_parallel_worker() -> None:
+	"""errors and warnings raise in workers, the iteration is then rendered serially"""
+	assert _parallel_loop is not None
+	preprocessor = _parallel_loop[0]
+	preprocessor.error_mode = ErrorMode.RAISE
+	preprocessor.warning_mode = WarningMode.RAISE
+
+def render_independent(record: Record) -> Optional[str]:
+	"""renders an iteration of a for --parallel loop in a worker
+	returns None if it fails or isn't independent from the others,
+	that is if it sends errors or warnings, runs impure commands or blocks
+	(other than the loop commands), modifies definitions, labels,
+	final actions, tokens or the include path"""
+	if _parallel_loop is None:
+		return None
+	preprocessor, idents, slots, commands, tree, checkpoint = _parallel_loop
+	bind_record(preprocessor, idents, slots, commands, record)
+	state = (
+		preprocessor._side_effects, len(preprocessor.final_actions), preprocessor.labels.size,
+		len(preprocessor.include_path), preprocessor.token_begin, preprocessor.token_end,
+		preprocessor.token_endblock, preprocessor.re_flags
+	)
+	mark = version_mark()
+	try:
+		preprocessor.context.rewind(checkpoint)
+		result = preprocessor.render(tree)
+	except Exception: # pylint: disable=broad-except
+		return None
+	if version_mark() != mark + 1 or state != (
+		preprocessor._side_effects, len(preprocessor.final_actions), preprocessor.labels.size,
+		len(preprocessor.include_path), preprocessor.token_begin, preprocessor.token_end,
+		preprocessor.token_endblock, preprocessor.re_flags
+	):
+		return None
+	return result
+
+def render_parallel(preprocessor: Preprocessor, processes: int, idents: List[str], slots: List[List[Any]],
+                    commands: List[TypeCommand], tree: Tree, checkpoint: Any,
+                    records: Iterator[Record], result: List[str]) -> List[Record]:
+	"""renders iterations in a pool of processes, appending them to result in order
+	stops at the first iteration a worker can't render,
+	returns it and the following records of its window, to render serially"""
+	global _parallel_loop # pylint: disable=global-statement
+	_parallel_loop = (preprocessor, idents, slots, commands, tree, checkpoint)
+	try:
+		pool = get_context("fork").Pool(processes, initializer=init_parallel_worker)
+	finally:
+		_parallel_loop = None
+	with pool:
+		while True:
+			window = list(islice(records, processes * PARALLEL_CHUNK_SIZE))
+			if not window:
+				return []
+			outputs = pool.map(render_independent, window, PARALLEL_CHUNK_SIZE)
+			for i, output in enumerate(outputs):
+				if output is None:
+					return window[i:]
+				result.append(output)
+			# the loop commands are left defined with the last values, as in serial loops
+			bind_record(preprocessor, idents, slots, commands, window[-1])
+
 def blck_for(preprocessor: Preprocessor, args: str, contents: str) -> str:
 	"""The for block, simple for loop
-	usage: for <ident> in range(stop)
-	                      range(start, stop)
-	                      range(start, stop, step)
-	       for <ident> in space separated list " argument with spaces"
+	usage: for [--parallel] <ident> in range(stop)
+	                                   range(start, stop)
+	                                   range(start, stop, step)
+	       for [--parallel] <ident> in space separated list " argument with spaces"
+	       for [--parallel] <ident>[, <ident>...] in file("path")
+	       for [--parallel] <ident>[, <ident>...] in zip(<list>[, <list>...])
 	"""
-	match = re.match(r"^\s*({})\s+in\s+".format(REGEX_IDENTIFIER), args)
+	match = re.match(r"^\s*(--parallel\s+|-p\s+)?({0}(?:\s*,\s*{0})*)\s+in\s+".format(REGEX_IDENTIFIER), args)
 	if match is None:
 		preprocessor.send_error("invalid-argument",
 			"Invalid syntax.\n"
-			"usage: for <ident> in range(stop)\n"
-	    "                      range(start, stop)\n"
-			"                      range(start, stop, step)\n"
-			"       for <ident> in space separated list \" argument with spaces\""
+			"usage: for [--parallel] <ident> in range(stop)\n"
+	    "                                   range(start, stop)\n"
+			"                                   range(start, stop, step)\n"
+			"       for [--parallel] <ident> in space separated list \" argument with spaces\"\n"
+			"       for [--parallel] <ident>[, <ident>...] in file(\"path\")\n"
+			"       for [--parallel] <ident>[, <ident>...] in zip(<list>[, <list>...])"
 		)
 		return ""
-	ident = match.group(1)
+	parallel = match.group(1) is not None
+	idents = [ident.strip() for ident in match.group(2).split(",")]
 	args = args[match.end():].strip()
-	iterator: Iterable = []
+	records: Iterable[Record] = []
+	tree: Optional[Tree] = None
+	tokens = None
+	file_match = re.match(REGEX_FOR_FILE, args)
+	zip_match = re.match(REGEX_FOR_ZIP, args)
+	if len(idents) != 1 and file_match is None and zip_match is None:
+		preprocessor.send_error("invalid-argument",
+			"Invalid syntax.\nmultiple loop variables require a file(\"path\") or zip(lists...) source"
+		)
+		return ""
 	if args[0:5] == "range":
 		regex = r"range\((?:\s*({nb})\s*,)?\s*({nb})\s*(?:,\s*({nb})\s*)?\)".format(
 			nb = REGEX_INTEGER)
@@ -292,42 +523,84 @@ def blck_for(preprocessor: Preprocessor, args: str, contents: str) -> str:
 			start = to_integer(groups[0])
 			if groups[2] is not None:
 				step = to_integer(groups[2])
-		iterator = range(start, stop, step)
+		records = ([(str(value), None)] for value in range(start, stop, step))
+	elif file_match is not None:
+		name = next(group for group in file_match.groups() if group is not None)
+		records = read_records(preprocessor, name, len(idents))
+	elif zip_match is not None:
+		names = [name.strip() for name in zip_match.group(1).split(",")]
+		records = zip_records(preprocessor, names, len(idents))
 	else:
-		iterator = preprocessor.split_args(args)
-	result = ""
-	for value in iterator:
-		def defined_value(preproc: Preprocessor, args: str) -> str:
-			"""new command defined in for block"""
-			if args.strip() != "":
-				preproc.send_warning("extra-arguments",
-					"Extra arguments.\nThe command {} defined in for loop takes no arguments".format(ident)
-				)
-			return str(value)
-		defined_value.__name__ = "for_cmd_{}".format(ident)
-		defined_value.__doc__ = "Command defined in for loop: {} = '{}'".format(ident, value)
-		defined_value.doc = defined_value.__doc__ # type: ignore
-		preprocessor.commands[ident] = defined_value
-		preprocessor.context.update(preprocessor.current_position.end, "in for block")
-		result += preprocessor.parse(contents)
-		preprocessor.context.pop()
-	return result
+		records = ([(value, None)] for value in preprocessor.split_args(args))
+	# the body is compiled once, each iteration only changes the values returned by the idents
+	slots: List[List[Any]] = [["", None] for _ in idents]
+	commands = [loop_command(ident, slot) for ident, slot in zip(idents, slots)]
+	result: List[str] = []
+	# idents are redefined, the loop commands are impure so iterations don't invalidate again
+	preprocessor.definitions_changed()
+	preprocessor.context.update(preprocessor.current_position.end, "in for block")
+	checkpoint = preprocessor.context.checkpoint()
+	records = iter(records)
+	processes = preprocessor.parallel_processes or cpu_count() or 1
+	if parallel and processes > 1 and "fork" in get_all_start_methods() and not current_process().daemon:
+		tree = preprocessor.compile(contents)
+		tokens = (preprocessor.token_begin, preprocessor.token_end, preprocessor.token_endblock, preprocessor.re_flags)
+		remaining = render_parallel(
+			preprocessor, processes, idents, slots, commands, tree, checkpoint, records, result
+		)
+		records = chain(remaining, records)
+	for record in records:
+		bind_record(preprocessor, idents, slots, commands, record)
+		key = (preprocessor.token_begin, preprocessor.token_end, preprocessor.token_endblock, preprocessor.re_flags)
+		if tree is None or key != tokens:
+			tree = preprocessor.compile(contents)
+			tokens = key
+		preprocessor.context.rewind(checkpoint)
+		result.append(preprocessor.render(tree))
+	preprocessor.context.pop()
+	for ident, slot, command in zip(idents, slots, commands):
+		command.__doc__ = "Command defined in for loop: {} = '{}'".format(ident, slot[0])
+		command.doc = command.__doc__ # type: ignore
+	return "".join(result)
 
 blck_for.doc = ( # type: ignore
 	"""
 	Simple for loop used to render a chunk of text multiple times.
 	ex: "{% for x in range(2) %}{% x %},{% endfor %}" -> "1,2,"
 
-	Usage: for <ident> in range(stop)
-	                      range(start, stop)
-	                      range(start, stop, step)
-	       for <ident> in space separated list " argument with spaces"
+	Usage: for [--parallel] <ident> in range(stop)
+	                                   range(start, stop)
+	                                   range(start, stop, step)
+	       for [--parallel] <ident> in space separated list " argument with spaces"
+	       for [--parallel] <ident>[, <ident>...] in file("path")
+	       for [--parallel] <ident>[, <ident>...] in zip(<list>[, <list>...])
+
+
+	file reads a data file lazily, one row per iteration (path is searched like include):
+	- .csv files: the first line is a header naming the fields
+	- .jsonl or .ndjson files: one json value per line
+	- other files: one value per line
+	with a single ident, "{% ident %}" prints the whole row and "{% ident field %}"
+	a field (by name for csv and objects, by position for arrays).
+	with multiple idents, each is bound to the next field of the row:
 
+	  "{% for name, age in file("people.csv") %}{% name %} (age {% age %})
+	  {% endfor %}"
+
+	with --parallel, iterations are rendered in a pool of processes
+	(preprocessor.parallel_processes, defaults to the number of cpus).
+	an iteration that sends errors or warnings, runs impure commands or blocks
+	(def, label, cut, atlabel, line...) or changes definitions, labels or
+	final actions is rendered again serially, as well as all the
+	following ones, so the output is always that of the serial loop.
+	use it on long loops whose iterations only read the loop variables.
 
-	range can be combined with the deflist command to iterate multiple lists:
+	zip iterates lists defined with the deflist command together,
+	each ident is bound to an element of the matching list.
+	It stops at the end of the shortest list:
 
 	  "{% deflist names alice john frank %} {% deflist ages 23 31 19 %}
-	  {% for i in range(3) %}{% names {% i %} %} (age {% ages {% i %} %})
+	  {% for name, age in zip(names, ages) %}{% name %} (age {% age %})
 	  {% endfor %}"
 
 	prints:
@@ -346,7 +619,7 @@ blck_for.doc = ( # type: ignore
 # ============================================================
 
 
-cut_parser = ArgumentParserNoExit(prog="cut", add_help=False)
+cut_parser = ArgumentMatcher(prog="cut")
 cut_parser.add_argument("--pre-render", "-p", action="store_true")
 cut_parser.add_argument("clipboard", nargs="?", default="")
 
@@ -375,6 +648,7 @@ def blck_cut(preprocessor: Preprocessor, args: str, contents: str) -> str:
 		preprocessor.command_vars["clipboard"] = {clipboard: (context, contents)}
 	else:
 		preprocessor.command_vars["clipboard"][clipboard] = (context, contents)
+		preprocessor.command_vars.touch("clipboard")
 	return ""
 
 blck_cut.doc = ( # type: ignore
@@ -406,50 +680,88 @@ blck_cut.doc = ( # type: ignore
 # if block
 # ============================================================
 
-def find_elifs_and_else(preproc: Preprocessor, string: str
-	) -> Tuple[int, int, Optional[str]]:
-	"""returns a tuple indicating the next elif/else:
-	(-1,-1,None) -> no matching elif/else
-	(begin, end, None) -> matching else at string[begin:end]
-	(begin, end, str) -> matchin elif with arguments str at string[begin:end]"""
+# branch of an if block: (begin, end, condition)
+# with the elif/else at string[begin:end] and condition the position
+# (begin, end) of the elif condition, None for else
+Branch = Tuple[int, int, Optional[Tuple[int, int]]]
+
+def find_branches(preproc: Preprocessor, string: str) -> Tuple[List[Branch], int]:
+	"""finds all elif/else of an if block (the ones not in nested if blocks)
+	in a single scan of its contents. Returns a tuple:
+	- branches: List[Branch] - the elif and else, in order
+	- error: int - position of an elif with no end token after the last branch
+	  (-1 if none), it should only raise an error when that branch is reached"""
 	tokens = preproc._find_tokens(string)
 	depth = 0
-	endif_regex = r"\s*{}if\s*{}".format(
-		re.escape(preproc.token_endblock),
-		re.escape(preproc.token_end)
-	)
-	if_regex = r"\s*if(?:{}|{})".format(
-		re.escape(preproc.token_end), REGEX_IDENTIFIER_END
-	)
-	elif_regex = r"\s*(elif)(?:{}|{})".format(
-		re.escape(preproc.token_end), REGEX_IDENTIFIER_END
-	)
-	else_regex = r"\s*else\s*{}".format(re.escape(preproc.token_end))
-	for i, (begin, end, token) in enumerate(tokens):
+	endif_regex = preproc._token_regex(r"\s*{endblock}if\s*{end}")
+	if_regex = preproc._token_regex(r"\s*if(?:{end}|" + REGEX_IDENTIFIER_END + ")")
+	elif_regex = preproc._token_regex(r"\s*(elif)(?:{end}|" + REGEX_IDENTIFIER_END + ")")
+	else_regex = preproc._token_regex(r"\s*else\s*{end}")
+	branches: List[Branch] = []
+	parenthese: Optional[List[str]] = None
+	# the search resumes at pos after each branch
+	pos = 0
+	i = 0
+	while i < len(tokens):
+		begin, end, token = tokens[i]
+		if begin < pos:
+			if end > pos:
+				# token overlapping the branch: scan again from there
+				tokens = tokens[:i] + [
+					(token_begin + pos, token_end + pos, kind)
+					for token_begin, token_end, kind in preproc._find_tokens(string[pos:])
+				]
+				parenthese = None
+			else:
+				i += 1
+			continue
 		if token == TokenMatch.OPEN:
-			if re.match(if_regex, string[end:], preproc.re_flags) is not None:
+			if if_regex.match(string, end) is not None:
 				depth += 1
-			elif re.match(endif_regex, string[end:], preproc.re_flags) is not None:
+			elif endif_regex.match(string, end) is not None:
 				depth -= 1
 			elif depth == 0:
-				match_else = re.match(else_regex, string[end:], preproc.re_flags)
-				match_elif = re.match(elif_regex, string[end:], preproc.re_flags)
+				match_else = else_regex.match(string, end)
+				match_elif = elif_regex.match(string, end)
 				if match_else is not None:
-					return (begin, end + match_else.end(), None)
-				if match_elif is not None:
-					parenthese = ["(" if x[2] == TokenMatch.OPEN else ")" for x in tokens]
+					branches.append((begin, match_else.end(), None))
+					pos = match_else.end()
+				elif match_elif is not None:
+					if parenthese is None:
+						parenthese = ["(" if x[2] == TokenMatch.OPEN else ")" for x in tokens]
 					j = find_matching_close_parenthese(parenthese, i)
 					if j == len(tokens):
-						preproc.context.update(begin + preproc.current_position.end, "in elif")
-						preproc.send_error("unmatched-open-token",
-							'Unmatched "{}" token in endif.\n'
-							'Add matching "{}" or use "{}begin{}" to place it.'.format(
-							preproc.token_begin, preproc.token_end, preproc.token_begin, preproc.token_end
-						))
-						preproc.context.pop()
-					end += match_elif.end(1)
-					return (begin, tokens[j][1], string[end:tokens[j][0]])
-	return (-1, -1, None)
+						return branches, begin
+					branches.append((begin, tokens[j][1], (match_elif.end(1), tokens[j][0])))
+					pos = tokens[j][1]
+		i += 1
+	return branches, -1
+
+def unmatched_elif_error(preproc: Preprocessor, pos: int) -> None:
+	"""raises the error for an elif with no end token at pos in the if block"""
+	preproc.context.update(pos + preproc.current_position.end, "in elif")
+	preproc.send_error("unmatched-open-token",
+		'Unmatched "{}" token in endif.\n'
+		'Add matching "{}" or use "{}begin{}" to place it.'.format(
+		preproc.token_begin, preproc.token_end, preproc.token_begin, preproc.token_end
+	))
+	preproc.context.pop()
+
+def find_elifs_and_else(preproc: Preprocessor, string: str
+	) -> Tuple[int, int, Optional[str]]:
+	"""returns a tuple indicating the next elif/else:
+	(-1,-1,None) -> no matching elif/else
+	(begin, end, None) -> matching else at string[begin:end]
+	(begin, end, str) -> matchin elif with arguments str at string[begin:end]"""
+	branches, error = find_branches(preproc, string)
+	if not branches:
+		if error != -1:
+			unmatched_elif_error(preproc, error)
+		return (-1, -1, None)
+	begin, end, condition = branches[0]
+	if condition is None:
+		return (begin, end, None)
+	return (begin, end, string[condition[0]:condition[1]])
 
 def blck_if(preprocessor: Preprocessor, args: str, contents: str) -> str:
 	"""the if block
@@ -459,32 +771,36 @@ def blck_if(preprocessor: Preprocessor, args: str, contents: str) -> str:
 	       {% endif %}
 	"""
 	value = condition_eval(preprocessor, args)
+	branches, error = find_branches(preprocessor, contents)
 	pos_0 = 0
 	desc = "in if block"
-	while True:
-		else_info = find_elifs_and_else(preprocessor, contents[pos_0:])
+	for index in range(len(branches) + 1):
+		if index == len(branches) and error != -1:
+			unmatched_elif_error(preprocessor, error)
 		if value:
-			endelse = pos_0 + else_info[0] if else_info[0] != -1 else len(contents)
+			endelse = branches[index][0] if index < len(branches) else len(contents)
 			preprocessor.context.update(pos_0 + preprocessor.current_position.end, desc)
 			parsed = preprocessor.parse(contents[pos_0:endelse])
 			preprocessor.context.pop()
 			return parsed
-		if else_info[0] == -1:
-			# no matching else
-			return ""
-		if else_info[2] is None:
+		if index == len(branches):
+			break
+		begin, end, condition = branches[index]
+		if condition is None:
 			value = not value
 			desc = "in else"
 		else:
 			preprocessor.context.update(
-				pos_0 + else_info[0] + preprocessor.current_position.end,
+				begin + preprocessor.current_position.end,
 				"in elif evaluation"
 			)
-			args = preprocessor.parse(else_info[2])
+			args = preprocessor.parse(contents[condition[0]:condition[1]])
 			preprocessor.context.pop()
 			value = condition_eval(preprocessor, args)
 			desc = "in elif"
-		pos_0 += else_info[1]
+		pos_0 = end
+	# no matching else
+	return ""
 
 blck_if.doc = ( # type: ignore
 	"""
@@ -511,3 +827,4 @@ blck_if.doc = ( # type: ignore
 	    | <condition> or <condition>
 	    | (<condition>)
 	""")
+blck_if.pure = True # type: ignore
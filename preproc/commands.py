@@ -4,11 +4,12 @@ Definitions of default preprocessor commands
 import argparse
 import re
 from datetime import datetime
-from os.path import abspath, dirname, isfile, join
-from typing import List
+from os.path import abspath, dirname
+from typing import Dict, List, Tuple
 
-from .context import FileDescriptor
+from .arguments import ArgumentMatcher
 from .defs import *
+from .nodes import Tree
 from .preprocessor import Preprocessor
 
 # ============================================================
@@ -61,6 +62,7 @@ cmd_version.doc = ( # type: ignore
 	"""
 	Prints the preprocessor version.
 	""")
+cmd_version.pure = True # type: ignore
 
 def cmd_filename(preprocessor: Preprocessor, args: str) -> str:
 	"""the file command - prints the current file name"""
@@ -93,9 +95,15 @@ cmd_line.doc = ( # type: ignore
 # ============================================================
 
 
-macro_parser = ArgumentParserNoExit(prog="macro", add_help=False)
+macro_parser = ArgumentMatcher(prog="macro")
 macro_parser.add_argument('vars', nargs='*') # arbitrary number of arguments
 
+# placeholders for macro arguments
+MACRO_PLACEHOLDER = "\000(arg {})\000"
+REGEX_MACRO_PLACEHOLDER = r"\000\(arg ({})\)\000"
+# number of compiled expansions kept per macro
+MACRO_TREE_CACHE_SIZE = 64
+
 def rreplace(string, old, new, occurrence = 1):
 	"""replace <occurence> number of old by new in string
 	starting with the right"""
@@ -111,42 +119,73 @@ def define_macro(preprocessor: Preprocessor, name: str, args: List[str], text: s
 	- text: str - the text the command prints. Occurences of args will
 	  be replaced by the corresponding value during the call.
 	  will only replace occurence that aren't part of a larger word
+	The macro is pure: expanding it has no side effects, so its calls
+	are memoized unless rendering the text runs impure commands or blocks
 	"""
 	# replace arg occurences with placeholder
 	for i, arg in enumerate(args):
 		text = re.sub(
 			REGEX_IDENTIFIER_WRAPPED.format(re.escape(arg)), # pattern
-			"\\1{}\\3".format("\000(arg {})\000".format(i)), # placeholder
+			"\\1{}\\3".format(MACRO_PLACEHOLDER.format(i)), # placeholder
 			text,
 			flags = re.MULTILINE
 		)
+	# split into literal text and argument slots:
+	# [text, slot, text, slot, ..., text]
+	segments = [text]
+	if args:
+		segments = re.split(REGEX_MACRO_PLACEHOLDER.format(
+			"|".join(str(i) for i in range(len(args)))
+		), text)
+	slots = [
+		(int(segments[i]), segments[i+1]) for i in range(1, len(segments), 2)
+	]
+	trees: Dict[Tuple[str, str, str, str, int], Tree] = dict()
+
 	# define the command
-	def cmd(pre: Preprocessor, cmd_args: List[str], text: str = text, ident: str = name) -> str:
+	def cmd(pre: Preprocessor, cmd_args: List[str], ident: str = name) -> str:
 		"""a defined macro command"""
-		for i, arg in enumerate(cmd_args):
-			pattern = re.escape("\000(arg {})\000".format(i))
-			text = re.sub(pattern, arg, text, flags=re.MULTILINE)
-
+		values = list(cmd_args)
+		for i, arg in enumerate(values):
+			if "\\" in arg:
+				# process escapes as re.sub would
+				placeholder = MACRO_PLACEHOLDER.format(i)
+				values[i] = re.sub(re.escape(placeholder), arg, placeholder)
+		pieces = [segments[0]]
+		for slot, literal in slots:
+			pieces.append(values[slot])
+			pieces.append(literal)
+		text = "".join(pieces)
+
+		if not pre._may_contain_tokens(text) and pre._recursion_depth + 1 < pre.max_recursion_depth:
+			# nothing to parse
+			return text
+		key = (text, pre.token_begin, pre.token_end, pre.token_endblock, pre.re_flags)
+		tree = trees.get(key)
+		if tree is None:
+			if len(trees) >= MACRO_TREE_CACHE_SIZE:
+				trees.clear()
+			tree = pre.compile(text)
+			trees[key] = tree
 		pre.context.update(
 			pre.current_position.cmd_argbegin,
 			'in expansion of defined command {}'.format(ident)
 		)
-		parsed = pre.parse(text)
+		parsed = pre.render(tree)
 		pre.context.pop()
 		return parsed
 
 	cmd.doc = "{} {}".format(name, " ".join(args)) # type: ignore
-	# place it in command_vars
+	# place it in command_vars["def"][name][number of arguments]
 	if "def" not in preprocessor.command_vars:
 		preprocessor.command_vars["def"] = dict()
-	preprocessor.command_vars["def"]["{}:{}".format(name, len(args))] = cmd
-
-	overloads = []
-	usages = []
-	for key, val in preprocessor.command_vars["def"].items():
-		if key.startswith(name+":"):
-			overloads.append(int(key[key.find(":") + 1]))
-			usages.append(val.doc)
+	# copied rather than updated, local blocks keep a shallow copy of command_vars["def"]
+	macro_overloads = preprocessor.command_vars["def"].get(name, dict()).copy()
+	macro_overloads[len(args)] = cmd
+	preprocessor.command_vars["def"][name] = macro_overloads
+
+	overloads = list(macro_overloads)
+	usages = [overload.doc for overload in macro_overloads.values()]
 	usage = "usage: " + "\n       ".join(usages)
 	overload_nb = rreplace(", ".join(str(x) for x in sorted(overloads)), ", ", " or ")
 
@@ -166,17 +205,17 @@ def define_macro(preprocessor: Preprocessor, name: str, args: List[str], text: s
 				"invalid number of arguments for macro.\nexpected {} got {}.\n"
 				"{}").format(overload_nb, len(arguments.vars), usage)
 			)
-		return pre.command_vars["def"]["{}:{}".format(name, len(arguments.vars))](
-			pre, arguments.vars
-		)
+		return pre.command_vars["def"][name][len(arguments.vars)](pre, arguments.vars)
 
 	defined_cmd.__doc__ = "Defined command for {} (expects {} arguments)\n{}".format(
 		name, overload_nb, usage
 	)
 	defined_cmd.doc = defined_cmd.__doc__ # type: ignore
 	defined_cmd.__name__ = """def_cmd_{}""".format(name)
+	defined_cmd.pure = True # type: ignore
 
 	preprocessor.commands[name] = defined_cmd
+	preprocessor.definitions_changed()
 
 def cmd_def(preprocessor: Preprocessor, args_string : str) -> str:
 	"""the define command - inspired by the C preprocessor's define
@@ -289,12 +328,8 @@ def cmd_undef(preprocessor: Preprocessor, args_string: str) -> str:
 			"canno't undef \"{}\", identifier is aldready undefined.".format(ident)
 		)
 	if "def" in preprocessor.command_vars:
-		del_keys = []
-		for key in preprocessor.command_vars:
-			if key.startswith(ident+"<"):
-				del_keys.append(key)
-		for key in del_keys:
-			del preprocessor.command_vars["def"][key]
+		preprocessor.command_vars["def"].pop(ident, None)
+	preprocessor.definitions_changed()
 	return ""
 
 cmd_undef.doc = ( # type: ignore
@@ -339,7 +374,10 @@ def cmd_deflist(preprocessor: Preprocessor, args_string: str) -> str:
 				args, ident)
 		)
 		return ""
+	defined_command.pure = True # type: ignore
+	defined_command.list = defined_list # type: ignore
 	preprocessor.commands[ident] = defined_command
+	preprocessor.definitions_changed()
 	return ""
 
 cmd_deflist.doc = ( # type: ignore
@@ -353,7 +391,8 @@ cmd_deflist.doc = ( # type: ignore
 		list_name <number> prints the n-th element
 		                   (number must be a between -length+1 and length+1)
 
-	Can be used in combination with the for block to iterate multiple lists in a loop.
+	Can be used in combination with the for block to iterate multiple lists in a loop:
+	  {% for a, b in zip(list1, list2) %}...{% endfor %}
 	""")
 
 # ============================================================
@@ -390,6 +429,7 @@ cmd_begin.doc = ( # type: ignore
 	  begin 0   -> "{%"
 	  begin <n> -> "{% begin <n-1> %}"
 	""")
+cmd_begin.pure = True # type: ignore
 
 def cmd_end(preprocessor: Preprocessor, args_string: str) -> str:
 	"""The end command, inserts token_end
@@ -421,6 +461,7 @@ cmd_end.doc = ( # type: ignore
 	  end 0   -> "%}"
 	  end <n> -> "{% end <n-1> %}"
 	""")
+cmd_end.pure = True # type: ignore
 
 def cmd_call(preprocessor: Preprocessor, args_string: str) -> str:
 	"""The call command: used to print begin and end tokens
@@ -441,6 +482,7 @@ cmd_call.doc = ( # type: ignore
 	For recursion you can stack calls:
 	"{% call call ... %}" -> "{% call ... %}"
 	""")
+cmd_call.pure = True # type: ignore
 
 # ============================================================
 # label/paste
@@ -470,19 +512,22 @@ cmd_label.doc = ( # type: ignore
 	to place text at all occurences of a label.
 	""")
 
-paste_parser = ArgumentParserNoExit(prog="cut", add_help=False)
+paste_parser = ArgumentMatcher(prog="cut")
 paste_parser.add_argument("--verbatim", "-v", action="store_true")
+paste_parser.add_argument("--fresh", "-f", action="store_true")
 paste_parser.add_argument("clipboard", nargs="?", default="")
 
 def cmd_paste(pre: Preprocessor, args: str) -> str:
 	"""the paste command
-	usage: paste [-v|--verbatim] [<clipboard_name>]"""
+	usage: paste [-v|--verbatim] [-f|--fresh] [<clipboard_name>]
+	  renders are cached in command_vars["paste_cache"][clipboard_name]
+	  and reused unless --fresh is set"""
 	split = pre.split_args(args)
 	try:
 		arguments = paste_parser.parse_args(split)
 	except argparse.ArgumentError:
 		pre.send_error("invalid-argument",
-			"invalid argument.\nusage: paste [-v|--verbatim] [<clipboard_name>]"
+			"invalid argument.\nusage: paste [-v|--verbatim] [-f|--fresh] [<clipboard_name>]"
 		)
 	clipboard = arguments.clipboard
 	if (
@@ -491,19 +536,38 @@ def cmd_paste(pre: Preprocessor, args: str) -> str:
 	):
 		pre.send_warning("paste-undefined", "trying to paste undefined clipboard")
 		return ""
-	context, text = pre.command_vars["clipboard"][clipboard]
+	entry = pre.command_vars["clipboard"][clipboard]
+	context, text = entry
 	if not arguments.verbatim:
+		if "paste_cache" not in pre.command_vars:
+			pre.command_vars["paste_cache"] = dict()
+		cache = pre.command_vars["paste_cache"]
+		# a render is reused until the clipboard is cut again or a definition it read changes
+		key = (entry, pre.token_begin, pre.token_end, pre.token_endblock, pre.re_flags, pre._recursion_depth)
+		cached = cache.get(clipboard)
+		if not arguments.fresh and cached is not None and cached[0] == key and pre.up_to_date(cached[2]):
+			pre.replay_reads(cached[2])
+			return cached[1]
+		side_effects = pre._side_effects
+		warnings = pre._warning_count
 		pre.context.new(context.file, context.position, context.description)
-		text = pre.parse(text)
+		text, reads = pre.parse_and_record(text)
 		pre.context.pop()
+		# renders with side effects (definitions, labels...) or warnings must be done again
+		if side_effects == pre._side_effects and warnings == pre._warning_count:
+			cache[clipboard] = (key, text, reads)
+		else:
+			cache.pop(clipboard, None)
 	return text
 
 cmd_paste.doc = ( # type: ignore
 	"""
 	Pastes the contents of a clipboard (defined in a cut block)
 
-	Usage: paste [-v|--verbatim] [clipboard]
+	Usage: paste [-v|--verbatim] [-f|--fresh] [clipboard]
 	  if --verbatim is set, paste the text as is, without rendering it
+	  renders are reused until the clipboard is cut again or a definition
+	  they use changes, if --fresh is set, the text is always rendered again
 	  clipboard is a string identifiyng the clipboard (default "").
 	  it must match a previous cut block's clipboard argument
 	""")
@@ -560,9 +624,8 @@ cmd_date.doc = ( # type: ignore
 # ============================================================
 
 
-include_parser = ArgumentParserNoExit(
-	prog="include", description="places the contents of the file at file_path",
-  add_help=False
+include_parser = ArgumentMatcher(
+	prog="include", description="places the contents of the file at file_path"
 )
 
 include_parser.add_argument("--verbatim", "-v", action="store_true")
@@ -584,17 +647,12 @@ def cmd_include(preprocessor: Preprocessor, args: str) -> str:
 		preprocessor.send_error("invalid-argument",
 			"invalid argument.\nusage: include [-v|--verbatim] file_path"
 		)
-	filepath = arguments.file_path
-	if not isfile(filepath):
-		for include in preprocessor.include_path:
-			if isfile(join(include, filepath)):
-				filepath = join(include, filepath)
-				break
-		else:
-			preprocessor.send_error("file-error",'file not found "{}"'.format(arguments.file_path))
+	filepath = preprocessor.find_file(arguments.file_path)
+	if filepath is None:
+		preprocessor.send_error("file-error",'file not found "{}"'.format(arguments.file_path))
+		return ""
 	try:
-		with open(filepath, "r") as file:
-			contents = file.read()
+		contents, descriptor = preprocessor.file_cache.read(filepath, arguments.file_path)
 	except FileNotFoundError:
 		preprocessor.send_error("file-error",'file not found "{}"'.format(arguments.file_path))
 	except PermissionError:
@@ -609,9 +667,10 @@ def cmd_include(preprocessor: Preprocessor, args: str) -> str:
 		if arguments.end is not None:
 			preprocessor.token_end = arguments.end
 		preprocessor.include_path.append(dirname(abspath(filepath)))
-		preprocessor.context.new(FileDescriptor(arguments.file_path, contents), 0, "in included file")
+		preprocessor.context.new(descriptor, 0, "in included file")
 		contents = preprocessor.parse(contents)
 		preprocessor.context.pop()
+		preprocessor.include_path.pop()
 		preprocessor.token_begin = begin
 		preprocessor.token_end = end
 	return contents
@@ -624,6 +683,7 @@ cmd_include.doc = ( # type: ignore
 	  path can be absolute or relative to
 	  any path in include_path: [current_working_dir, input_file_dir, output_file_dir]
 	  paths can be added to include_path with the --include/-i/-I preprocessor option
+	  while an included file is parsed, its directory is added to include_path
 
 	Options:
 	  -b --begin <string> specify the begin token ("{%")
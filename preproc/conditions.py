@@ -1,56 +1,35 @@
 """This module encodes a simple conditional
 evaluation system"""
 
-from typing import List
+import re
+from typing import Callable, Dict, List
 
 from .preprocessor import Preprocessor
 
-SINGLE_CHAR_OPERATORS = "()"
-DOUBLE_CHAR_OPERATORS = ["==", "!="]
+
+# whitespace | operator | "string" (possibly unterminated) | word
+REGEX_CONDITION_LEXEME = re.compile(
+	r'\s+|([()]|==|!=)|"([^"]*)(")?|((?:(?!==|!=)[^\s()"])+)'
+)
+
+CompiledCondition = Callable[[Preprocessor], bool]
+
+# compiled conditions by source string
+CONDITION_CACHE_SIZE = 256
+_compiled_conditions: Dict[str, CompiledCondition] = dict()
 
 def condition_lexer(string : str) -> List[str]:
 	"""lexes the input string into a stream of tokens"""
 	lexemes : List[str] = []
-	in_string = False
-	current_lexeme = ""
-	str_len = len(string)
-	i = 0
-	while i < str_len:
-		char = string[i]
-		if in_string:
-			if char == '"':
-				in_string = False
-				lexemes.append(current_lexeme)
-				current_lexeme = ""
-			else:
-				current_lexeme += char
-		else:
-			# not in a string
-			if char in SINGLE_CHAR_OPERATORS:
-				if current_lexeme != "":
-					lexemes.append(current_lexeme)
-				lexemes.append(char)
-				current_lexeme = ""
-			elif i+1 < str_len and string[i:i+2] in DOUBLE_CHAR_OPERATORS:
-				if current_lexeme != "":
-					lexemes.append(current_lexeme)
-				lexemes.append(string[i:i+2])
-				current_lexeme = ""
-				i += 1
-			elif char == '"':
-				if current_lexeme != "":
-					lexemes.append(current_lexeme)
-				current_lexeme = ""
-				in_string = True
-			elif char.isspace():
-				if current_lexeme != "":
-					lexemes.append(current_lexeme)
-				current_lexeme = ""
-			else:
-				current_lexeme += char
-		i += 1
-	if current_lexeme:
-		lexemes.append(current_lexeme)
+	for match in REGEX_CONDITION_LEXEME.finditer(string):
+		operator, text, closed, word = match.groups()
+		if operator is not None:
+			lexemes.append(operator)
+		elif word is not None:
+			lexemes.append(word)
+		elif text is not None and (closed or text):
+			# strings are kept even if empty, unless unterminated
+			lexemes.append(text)
 	return lexemes
 
 def find_matching_close_parenthese(tokens: List[str], start_index: int) -> int:
@@ -69,71 +48,112 @@ def find_matching_close_parenthese(tokens: List[str], start_index: int) -> int:
 		j += 1
 	return j
 
-def condition_evaluator(preproc: Preprocessor, tokens: List[str]) -> bool:
-	"""evaluates a string of tokens into a boolean"""
-	i = 0
+def _condition_error(message: str) -> CompiledCondition:
+	"""a condition that raises an invalid-condition error when evaluated"""
+	def condition(preproc: Preprocessor) -> bool:
+		preproc.send_error("invalid-condition", message)
+		return False
+	return condition
+
+def _matching_parentheses(tokens: List[str]) -> List[int]:
+	"""for each "(" in tokens, the index of the matching ")"
+	(as returned by find_matching_close_parenthese), in a single scan"""
 	len_tok = len(tokens)
-	while i < len_tok:
+	matches = [len_tok] * len_tok
+	opened: List[int] = []
+	for i, tok in enumerate(tokens):
+		if tok == "(":
+			opened.append(i)
+		elif tok == ")" and opened:
+			matches[opened.pop()] = i
+	return matches
+
+def _compile(tokens: List[str], matches: List[int], start: int, stop: int) -> CompiledCondition:
+	"""compiles tokens[start:stop], matches are the parentheses of tokens
+	operators are split in the same order as the evaluation used to,
+	errors are only raised when (and if) the faulty part is evaluated"""
+	i = start
+	while i < stop:
 		tok = tokens[i]
 		if tok == "(":
-			j = find_matching_close_parenthese(tokens, i)
-			if j == len_tok:
-				preproc.send_error("invalid-condition",
+			j = matches[i]
+			if j >= stop:
+				return _condition_error(
 					"invalid condition syntax.\n"
 					"Unmatched \"(\". (missing closing parenthese?)"
 				)
-			if i == 0 and j == len_tok-1:
-				return condition_evaluator(preproc, tokens[1:-1])
+			if i == start and j == stop-1:
+				return _compile(tokens, matches, start+1, stop-1)
 			i = j
 		elif tok == ")":
-			preproc.send_error("invalid-condition",
+			return _condition_error(
 				"invalid condition syntax.\n"
 				"Unmatched \")\". (missing openning parenthese?)"
 			)
 		elif tok == "and":
+			left = _compile(tokens, matches, start, i)
+			right = _compile(tokens, matches, i+1, stop)
 			# uses python lazy evaluation
-			return condition_evaluator(preproc, tokens[:i])\
-				and condition_evaluator(preproc, tokens[i+1:])
+			return lambda preproc: left(preproc) and right(preproc)
 		elif tok == "or":
+			left = _compile(tokens, matches, start, i)
+			right = _compile(tokens, matches, i+1, stop)
 			# uses python lazy evaluation
-			return condition_evaluator(preproc, tokens[:i])\
-				or condition_evaluator(preproc, tokens[i+1:])
+			return lambda preproc: left(preproc) or right(preproc)
 		elif tok == "not":
-			if i != 0:
-				preproc.send_error("invalid-condition",
+			if i != start:
+				return _condition_error(
 					'invalid condition syntax.\n'
 					'"not" must be preceeded by "and", "or" or "("\n'
 					'got "{} not"'.format(tokens[i-1])
 				)
-			return not condition_evaluator(preproc, tokens[1:])
+			operand = _compile(tokens, matches, start+1, stop)
+			return lambda preproc: not operand(preproc)
 		i += 1
-	return simple_condition_evaluator(preproc, tokens)
+	return compile_simple_condition(tokens[start:stop])
 
-def simple_condition_evaluator(preproc: Preprocessor, tokens: List[str]) -> bool:
-	"""evaluates a string of tokens into a boolean,
-	assumes the string of tokens doesn't contain "and", "or" and "not"
-	"""
+def compile_condition(tokens: List[str]) -> CompiledCondition:
+	"""compiles a string of tokens into a function of the preprocessor
+	returning a boolean, evaluated like condition_evaluator(preproc, tokens)"""
+	return _compile(tokens, _matching_parentheses(tokens), 0, len(tokens))
+
+def compile_simple_condition(tokens: List[str]) -> CompiledCondition:
+	"""compiles a string of tokens, assumed to not contain "and", "or" and "not"
+	definitions are looked up when the condition is evaluated"""
 	len_tok = len(tokens)
 	if len_tok == 1:
-		return not(tokens[0] in ["false", "0", ""])
+		value = not(tokens[0] in ["false", "0", ""])
+		return lambda preproc: value
 	if len_tok == 2:
+		name = tokens[1]
 		if tokens[0] == "def":
-			return tokens[1] in preproc.commands or tokens[1] in preproc.blocks
+			return lambda preproc: name in preproc.commands or name in preproc.blocks
 		if tokens[0] == "ndef":
-			return not (tokens[1] in preproc.commands or tokens[1] in preproc.blocks)
+			return lambda preproc: not (name in preproc.commands or name in preproc.blocks)
 	if len_tok == 3:
 		if tokens[1] == "==":
-			return tokens[0] == tokens[2]
+			value = tokens[0] == tokens[2]
+			return lambda preproc: value
 		if tokens[1] == "!=":
-			return tokens[0] != tokens[2]
-	preproc.send_error("invalid-condition",
+			value = tokens[0] != tokens[2]
+			return lambda preproc: value
+	return _condition_error(
 		"invalid condition syntax.\n"
 		"simple conditions are: \n"
 		"  | true | false | 1 | 0 | <string>\n"
 		"  | def <identifier> | ndef <identifier>\n"
 		"  | <str> == <str> | <str> != <str>"
 	)
-	return False
+
+def condition_evaluator(preproc: Preprocessor, tokens: List[str]) -> bool:
+	"""evaluates a string of tokens into a boolean"""
+	return compile_condition(tokens)(preproc)
+
+def simple_condition_evaluator(preproc: Preprocessor, tokens: List[str]) -> bool:
+	"""evaluates a string of tokens into a boolean,
+	assumes the string of tokens doesn't contain "and", "or" and "not"
+	"""
+	return compile_simple_condition(tokens)(preproc)
 
 def condition_eval(preproc: Preprocessor, string: str) -> bool:
 	"""evaluates a condition.
@@ -149,5 +169,10 @@ def condition_eval(preproc: Preprocessor, string: str) -> bool:
 		| <condition> and <condition>
 		| <condition> or <condition>
 		| (<condition>)"""
-	lexemes = condition_lexer(string)
-	return condition_evaluator(preproc, lexemes)
+	condition = _compiled_conditions.get(string)
+	if condition is None:
+		if len(_compiled_conditions) >= CONDITION_CACHE_SIZE:
+			_compiled_conditions.clear()
+		condition = compile_condition(condition_lexer(string))
+		_compiled_conditions[string] = condition
+	return condition(preproc)
@@ -4,13 +4,15 @@ It contains:
 
 - class FileDescriptor
 	contains info about a file (name, contents and linebreaks)
+	linebreaks are computed on first use and shared between
+	descriptors of the same file
 
 - class ContextElement
 	stores a current context with
 	- a FileDescriptor (file to point back to when reporting errors)
 	- a position
 	- a description
-	- a list of dilatations that account for insertion/deletions
+	- a map of dilatations that account for insertion/deletions
 
 - class ContextStack:
 	a stack of ContextElements
@@ -20,7 +22,16 @@ It contains:
 """
 
 import re
+from bisect import bisect_right
 from typing import List, Optional, Tuple
+from weakref import WeakValueDictionary
+
+from .dilatations import DilatationMap
+
+
+class _LineBreaks(List[int]):
+	"""list of line break positions,
+	subclassed so it can be weakly referenced"""
 
 
 class FileDescriptor:
@@ -28,17 +39,33 @@ class FileDescriptor:
 	contains:
 	- file name
 	- file initial contents
-	- line breaks"""
+	- line breaks (computed on first use)"""
 
 	filename: str
 	contents: str
-	_line_breaks: List[int]
+	_line_breaks_list: Optional[_LineBreaks]
+
+	# line breaks of the files described by live FileDescriptors
+	_shared_line_breaks: "WeakValueDictionary[Tuple[str, str], _LineBreaks]" = WeakValueDictionary()
 
 	def __init__(self: "FileDescriptor", filename: str, contents: str) -> None:
-		"""initialises the FileDescriptor element and computes linebreaks"""
+		"""initialises the FileDescriptor element"""
 		self.filename = filename
 		self.contents = contents
-		self._line_breaks = self.line_breaks_from_str(contents)
+		self._line_breaks_list = None
+
+	@property
+	def _line_breaks(self: "FileDescriptor") -> List[int]:
+		"""the sorted list of line break positions,
+		computed on first use or reused from a descriptor of the same file"""
+		if self._line_breaks_list is None:
+			key = (self.filename, self.contents)
+			line_breaks = self._shared_line_breaks.get(key)
+			if line_breaks is None:
+				line_breaks = _LineBreaks(self.line_breaks_from_str(self.contents))
+				self._shared_line_breaks[key] = line_breaks
+			self._line_breaks_list = line_breaks
+		return self._line_breaks_list
 
 	@staticmethod
 	def line_breaks_from_str(string: str) -> List[int]:
@@ -51,14 +78,12 @@ class FileDescriptor:
 	def line_number(self: "FileDescriptor", pos: int) -> Tuple[int, int]:
 		"""Returns a tuple (line number, char number on line)
 		from an absolute position"""
-		line_nb = 1
-		closest_line_end = 0
-		for line_end in self._line_breaks:
-			if line_end <= pos:
-				line_nb += 1
-				if pos - line_end < pos - closest_line_end:
-					closest_line_end = line_end
-		return line_nb, pos - closest_line_end
+		line_breaks = self._line_breaks
+		# number of line breaks before pos (line_breaks is sorted)
+		line_index = bisect_right(line_breaks, pos)
+		if line_index == 0:
+			return 1, pos
+		return line_index + 1, pos - line_breaks[line_index - 1]
 
 
 class ContextElement:
@@ -73,7 +98,7 @@ class ContextElement:
 	description: str
 	position: int
 	is_new: bool
-	_dilatations: List[Tuple[int, int]]
+	_dilatations: DilatationMap
 
 	def __init__(
 		self: "ContextElement", file: FileDescriptor, desc: str, pos: int, is_new: bool = True
@@ -83,15 +108,12 @@ class ContextElement:
 		self.description = desc
 		self.position = pos
 		self.is_new = is_new
-		self._dilatations = []
+		self._dilatations = DilatationMap()
 
 	def true_position(self: "ContextElement", position: int) -> int:
 		"""Returns the true position, taking dilatations
 		into account"""
-		for pos, value in self._dilatations[::-1]:
-			if pos <= position:
-				position -= value
-		return position
+		return self._dilatations.true_position(position)
 
 	def add_dilatation(self: "ContextElement", pos: int, value: int) -> None:
 		"""Adds a dilatation, i.e. indicates that
@@ -99,16 +121,15 @@ class ContextElement:
 		Ex when changing "bar foo bar" to "bar newfoo bar"
 		  add a dilatation (pos = 4, value = len("newfoo") - len("foo"))
 		"""
-		if value != 0:
-			self._dilatations.append((pos, value))
+		self._dilatations = self._dilatations.add(pos, value)
 
 	def copy(self: "ContextElement", position: int, desc: Optional[str] = None) -> "ContextElement":
-		"""returns a copy of self"""
+		"""returns a copy of self
+		the dilatation map is immutable, so it is shared"""
 		if desc is None:
 			desc = self.description
 		copy = ContextElement(self.file, desc, position, False)
-		for pos, value in self._dilatations:
-			copy.add_dilatation(pos, value)
+		copy._dilatations = self._dilatations
 		return copy
 
 
@@ -159,6 +180,16 @@ class ContextStack:
 		  add a dilatation (pos = 4, value = len("newfoo") - len("foo"))"""
 		self.top.add_dilatation(pos, value)
 
+	def checkpoint(self: "ContextStack") -> DilatationMap:
+		"""returns the dilatations of the topmost context, to restore with rewind"""
+		return self.top._dilatations
+
+	def rewind(self: "ContextStack", checkpoint: DilatationMap) -> None:
+		"""restores the dilatations of the topmost context to a checkpoint,
+		dropping those added since. Used to render the same string again
+		without pushing a new context"""
+		self.top._dilatations = checkpoint
+
 	def trace(self: "ContextStack") -> str:
 		"""Returns a string trace for error solving.
 		It is in the format:
@@ -9,10 +9,12 @@ namely:
 - function process_string to process read string ("\\n" into newline)
 - functions is_integer or to_integer to get ints from strings
 - function get_identifier_name to find the first identifier in a string
+- function overlapping_tokens to find strings containing overlapping tokens
 """
 import argparse
 import enum
 import re
+from functools import lru_cache
 from typing import Tuple
 
 PREPROCESSOR_NAME = "preproc"
@@ -162,6 +164,20 @@ def get_identifier_name(string: str) -> Tuple[str, str, int]:
 	return match.group(1), match.group(2), match.start(2)
 
 
+@lru_cache(maxsize=16)
+def overlapping_tokens(token_begin: str, token_end: str) -> Tuple[str, ...]:
+	"""returns the shortest strings in which a begin and an end token overlap
+	ex: overlapping_tokens("{%", "%}") -> ("{%}",)
+	a string containing none of these has disjoint tokens"""
+	overlaps = []
+	for first, second in ((token_begin, token_end), (token_end, token_begin)):
+		for i in range(len(first)):
+			# second starts at first[i]
+			common = min(len(first) - i, len(second))
+			if first[i:i+common] == second[:common]:
+				overlaps.append(first + second[common:])
+	return tuple(overlaps)
+
 def is_integer(string: str) -> bool:
 	"""returns True if string can safely be converted
 	to a integer with to_integer(string)"""
@@ -0,0 +1,196 @@
+"""This module implements the structure used by ContextElement to map
+positions in a modified string back to positions in its source.
+
+It contains:
+
+- class DilatationMap
+	an immutable map of dilatations, i.e. insertions/deletions
+	- add(pos, value) returns a new map with an extra dilatation in O(log n)
+	- true_position(pos) undoes all dilatations in O(log n)
+	  (except for positions in inserted text, see below)
+	maps share most of their structure, so copying one is free
+"""
+
+from random import random
+from typing import Optional, Tuple
+
+# dilatations in reverse order of addition: (pos, value, previous)
+History = Optional[Tuple[int, int, "History"]]
+
+
+class _Interval:
+	"""a node of the map, represents the interval of positions starting at key
+	(and ending at the next key) which are moved by offset:
+	true_position(x) = x - offset, unless folded is True.
+	Folded intervals contain text inserted by a dilatation, which maps back
+	onto the text before it, so their positions aren't moved by a constant.
+	delta is added to the key and offset of all nodes of the subtree.
+	Nodes are never modified once built, to share them between maps."""
+
+	__slots__ = ("key", "offset", "delta", "size", "left", "right", "folded")
+
+	key: int
+	offset: int
+	delta: int
+	size: int
+	left: Optional["_Interval"]
+	right: Optional["_Interval"]
+	folded: bool
+
+	def __init__(self: "_Interval",
+		key: int, offset: int, delta: int,
+		left: Optional["_Interval"], right: Optional["_Interval"],
+		folded: bool = False
+	) -> None:
+		self.key = key
+		self.offset = offset
+		self.delta = delta
+		self.left = left
+		self.right = right
+		self.folded = folded
+		self.size = 1
+		if left is not None:
+			self.size += left.size
+		if right is not None:
+			self.size += right.size
+
+
+def _shifted(node: Optional[_Interval], delta: int) -> Optional[_Interval]:
+	"""returns node with delta added to all its keys and offsets"""
+	if node is None or delta == 0:
+		return node
+	return _Interval(node.key, node.offset, node.delta + delta, node.left, node.right, node.folded)
+
+def _with_children(
+	node: _Interval, left: Optional[_Interval], right: Optional[_Interval]
+) -> _Interval:
+	"""returns a copy of node with new children, applying its delta to itself
+	(left and right should already account for it)"""
+	return _Interval(node.key + node.delta, node.offset + node.delta, 0, left, right, node.folded)
+
+def _split(node: Optional[_Interval], key: int) -> Tuple[Optional[_Interval], Optional[_Interval]]:
+	"""splits node into the intervals starting before key and the others"""
+	if node is None:
+		return None, None
+	left = _shifted(node.left, node.delta)
+	right = _shifted(node.right, node.delta)
+	if node.key + node.delta < key:
+		right, rest = _split(right, key)
+		return _with_children(node, left, right), rest
+	rest, left = _split(left, key)
+	return rest, _with_children(node, left, right)
+
+def _merge(left: Optional[_Interval], right: Optional[_Interval]) -> Optional[_Interval]:
+	"""concatenates two maps, all keys of left should be smaller than those of right
+	the root is chosen randomly weighted by size, which keeps the
+	tree balanced without storing priorities"""
+	if left is None:
+		return right
+	if right is None:
+		return left
+	if random() * (left.size + right.size) < left.size:
+		if left.delta == 0:
+			return _Interval(left.key, left.offset, 0, left.left, _merge(left.right, right), left.folded)
+		return _with_children(left,
+			_shifted(left.left, left.delta),
+			_merge(_shifted(left.right, left.delta), right)
+		)
+	if right.delta == 0:
+		return _Interval(right.key, right.offset, 0, _merge(left, right.left), right.right, right.folded)
+	return _with_children(right,
+		_merge(left, _shifted(right.left, right.delta)),
+		_shifted(right.right, right.delta)
+	)
+
+
+class DilatationMap:
+	"""maps positions in a modified string back to the original string
+	ex: dilatations = DilatationMap().add(4, 3) # "bar foo" -> "bar newfoo"
+	    dilatations.true_position(8) -> 5
+
+	Dilatations are undone from the latest to the first:
+	with dilatations (pos_1, value_1), ..., (pos_n, value_n)
+	  for pos, value in reversed(dilatations):
+	    if pos <= position:
+	      position -= value
+	The map stores the composition of these steps as a sorted set of
+	intervals, each moved by a constant offset.
+	Positions in inserted text (between pos and pos + value) are the exception,
+	they are found by undoing the dilatations one by one as above."""
+
+	_root: Optional[_Interval]
+	_last: Optional[int] # largest key in the map
+	_history: History
+
+	def __init__(self: "DilatationMap",
+		root: Optional[_Interval] = None, last: Optional[int] = None, history: History = None
+	) -> None:
+		"""initializes a map, empty by default"""
+		self._root = root
+		self._last = last
+		self._history = history
+
+	def __len__(self: "DilatationMap") -> int:
+		"""the number of intervals in the map"""
+		if self._root is None:
+			return 0
+		return self._root.size
+
+	def _find(self: "DilatationMap", position: int) -> Tuple[int, bool]:
+		"""offset and folded flag of the interval containing position"""
+		offset = 0
+		folded = False
+		delta = 0
+		node = self._root
+		while node is not None:
+			delta += node.delta
+			if node.key + delta <= position:
+				offset = node.offset + delta
+				folded = node.folded
+				node = node.right
+			else:
+				node = node.left
+		return offset, folded
+
+	def true_position(self: "DilatationMap", position: int) -> int:
+		"""returns the position before all dilatations"""
+		offset, folded = self._find(position)
+		if not folded:
+			return position - offset
+		history = self._history
+		while history is not None:
+			pos, value, history = history
+			if pos <= position:
+				position -= value
+		return position
+
+	def add(self: "DilatationMap", pos: int, value: int) -> "DilatationMap":
+		"""returns a new map with an added dilatation, i.e. positions
+		after pos are increased/decreased by value"""
+		if value == 0:
+			return self
+		history = (pos, value, self._history)
+		# x < pos -> unchanged
+		# x >= pos -> position x - value before this dilatation
+		# most dilatations come after all others, no need to split then
+		is_last = self._last is None or self._last < pos
+		before = self._root
+		if not is_last:
+			before, _ = _split(self._root, pos)
+		# the interval containing pos - value, moved to pos
+		start = pos + value if value > 0 else pos
+		offset, folded = self._find(start - value)
+		interval = _Interval(start, offset + value, 0, None, None, folded)
+		if value > 0:
+			# inserted text
+			interval = _Interval(pos, 0, 0, None, interval, True)
+		pos = start
+		root = _merge(before, interval)
+		if is_last:
+			return DilatationMap(root, pos, history)
+		_, after = _split(self._root, pos - value + 1)
+		if after is None:
+			return DilatationMap(root, pos, history)
+		# not is_last, so there is a last position
+		assert self._last is not None
+		return DilatationMap(_merge(root, _shifted(after, value)), self._last + value, history)
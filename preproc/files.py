@@ -0,0 +1,84 @@
+"""Module to cache the contents of included files
+- files are keyed by their resolved path, and reread when their size or
+  modification time changes
+- a cache stores the decoded contents of each file and a FileDescriptor
+  per name the file was included with, shared by all its includes
+- FILE_CACHE is the process-wide cache used by default by all preprocessors"""
+
+from collections import OrderedDict
+from os import stat
+from os.path import realpath
+from typing import Dict, Tuple
+
+from .context import FileDescriptor
+
+
+class _CachedFile:
+	"""contents of a file, with the size and modification time it was read with"""
+
+	size: int
+	mtime: int
+	contents: str
+	descriptors: Dict[str, FileDescriptor]
+
+	def __init__(self: "_CachedFile", size: int, mtime: int, contents: str) -> None:
+		self.size = size
+		self.mtime = mtime
+		self.contents = contents
+		self.descriptors = dict()
+
+
+class FileCache:
+	"""a cache of file contents, by resolved path
+	holds at most max_files files, dropping the least recently read ones.
+	hits and misses count calls to read"""
+
+	max_files: int
+	hits: int
+	misses: int
+	_files: "OrderedDict[str, _CachedFile]"
+
+	def __init__(self: "FileCache", max_files: int = 256) -> None:
+		self.max_files = max_files
+		self.hits = 0
+		self.misses = 0
+		self._files = OrderedDict()
+
+	def __len__(self: "FileCache") -> int:
+		return len(self._files)
+
+	def read(self: "FileCache", path: str, name: str) -> Tuple[str, FileDescriptor]:
+		"""returns the contents of the file at path, and a FileDescriptor
+		named name describing it (the same for all reads with the same name)
+		raises the same exceptions as open and read (OSError, UnicodeDecodeError...)"""
+		resolved = realpath(path)
+		status = stat(resolved)
+		cached = self._files.get(resolved)
+		if cached is not None and cached.size == status.st_size and cached.mtime == status.st_mtime_ns:
+			self.hits += 1
+			self._files.move_to_end(resolved)
+		else:
+			self.misses += 1
+			with open(resolved, "r") as file:
+				contents = file.read()
+			cached = _CachedFile(status.st_size, status.st_mtime_ns, contents)
+			if self.max_files > 0:
+				self._files[resolved] = cached
+				self._files.move_to_end(resolved)
+				if len(self._files) > self.max_files:
+					self._files.popitem(last=False)
+		descriptor = cached.descriptors.get(name)
+		if descriptor is None:
+			descriptor = FileDescriptor(name, cached.contents)
+			cached.descriptors[name] = descriptor
+		return cached.contents, descriptor
+
+	def clear(self: "FileCache") -> None:
+		"""empties the cache and resets the hit and miss counts"""
+		self._files.clear()
+		self.hits = 0
+		self.misses = 0
+
+
+# shared by all preprocessors, unless their file_cache attribute is changed
+FILE_CACHE = FileCache()
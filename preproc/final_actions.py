@@ -6,8 +6,10 @@ import argparse
 import re
 from typing import Callable, Optional
 
-from .defs import REGEX_IDENTIFIER_WRAPPED, ArgumentParserNoExit
+from .arguments import ArgumentMatcher
+from .defs import REGEX_IDENTIFIER_WRAPPED
 from .preprocessor import Preprocessor
+from .rope import Rope
 
 
 def final_action_command(function: Callable[[Preprocessor, str], str], name: Optional[str] = None
@@ -30,21 +32,20 @@ def final_action_command(function: Callable[[Preprocessor, str], str], name: Opt
 def final_action_replace(preprocessor: Preprocessor, string: str,
 	pattern: str, replacement: str, flags: re.RegexFlag, count:int = 0) -> str:
 	"""same as string = re.sub(pattern, replacement, string)
-	but uses preprocessor string_replace to offset labels correctly"""
-	matches = []
-	for re_match in re.finditer(pattern, string, flags=flags):
-		matches.append((re_match.start(), re_match.end(), re_match.group()))
-	replaced_nb = 0
-	while matches:
-		match = matches[0]
-		local_repl = re.sub(pattern, replacement, match[2], flags=flags)
-		string = preprocessor.replace_string(match[0], match[1], string, local_repl, matches)
-		replaced_nb += 1
+	but signals each replacement to the preprocessor to offset labels correctly"""
+	buffer = Rope(string)
+	offset = 0
+	for replaced_nb, re_match in enumerate(re.finditer(pattern, string, flags=flags), 1):
+		start = re_match.start() + offset
+		end = re_match.end() + offset
+		local_repl = re.sub(pattern, replacement, re_match.group(), flags=flags)
+		buffer.replace(start, end, local_repl)
+		dilat = len(local_repl) - (end - start)
+		preprocessor._dilate(start, end, dilat)
+		offset += dilat
 		if replaced_nb == count:
-			return string
-		if matches and match == matches[0]:
-			del matches[0]
-	return string
+			break
+	return str(buffer)
 
 # ============================================================
 # strip commands
@@ -146,9 +147,7 @@ cmd_strip.doc = ( # type: ignore
 # ============================================================
 
 
-replace_parser = ArgumentParserNoExit(
-	prog="replace", add_help=False
-)
+replace_parser = ArgumentMatcher(prog="replace")
 
 replace_parser.add_argument("--regex", "-r", action="store_true")
 replace_parser.add_argument("--ignore-case", "-i", action="store_true")
@@ -235,6 +234,11 @@ cmd_replace.doc = ( # type: ignore
 # upper/lower/capitalize commands
 # ============================================================
 
+def has_text(args: str) -> bool:
+	"""purity of upper, lower and capitalize:
+	they are pure when given text, and queue a final action otherwise"""
+	return args.strip() != ""
+
 def fnl_upper(_: Preprocessor, string: str) -> str:
 	"""Final action for upper, transforms
 	text in string to UPPER CASE"""
@@ -263,6 +267,7 @@ cmd_upper.doc = ( # type: ignore
 	If text is present, converts text
 	else converts everything in the document (can be restricted with block).
 	""")
+cmd_upper.pure = has_text # type: ignore
 
 def fnl_lower(_: Preprocessor, string: str) -> str:
 	"""Final action for upper, transforms
@@ -292,6 +297,7 @@ cmd_lower.doc = ( # type: ignore
 	If text is present, converts text
 	else converts everything in the document (can be restricted with block).
 	""")
+cmd_lower.pure = has_text # type: ignore
 
 def fnl_capitalize(_: Preprocessor, string: str) -> str:
 	"""Final action for upper, transforms
@@ -321,3 +327,4 @@ cmd_capitalize.doc = ( # type: ignore
 	If text is present, converts text
 	else converts everything in the document (can be restricted with block).
 	""")
+cmd_capitalize.pure = has_text # type: ignore
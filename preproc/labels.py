@@ -3,7 +3,8 @@
 - labels are grouped """
 
 
-from typing import Dict, List
+from bisect import bisect_right
+from typing import Dict, List, Optional, Tuple
 
 
 class LabelStackError(ValueError):
@@ -19,12 +20,145 @@ class TooShortLabelStack(LabelStackError):
 	"""Raised when trying to collapse an
 	empty or 1-deep stack"""
 
+
+class _LabelLevel:
+	"""a level of the label stack, stores all its positions in a sorted array
+	(with the label of each position alongside).
+	The array is split into chunks, each with an offset added to all its positions,
+	so that dilatations only update one chunk and the offsets of the following ones"""
+
+	_chunks: List[List[int]] # positions, minus the chunk offset
+	_names: List[List[str]] # label of each position
+	_offsets: List[int]
+
+	CHUNK_SIZE: int = 64
+
+	def __init__(self: "_LabelLevel") -> None:
+		self._chunks = []
+		self._names = []
+		self._offsets = []
+
+	def _last(self: "_LabelLevel", chunk: int) -> int:
+		"""returns the last position of a chunk"""
+		return self._chunks[chunk][-1] + self._offsets[chunk]
+
+	def _find_chunk(self: "_LabelLevel", pos: int) -> int:
+		"""index of the first chunk with a position greater than pos
+		(len(self._chunks) if there are none)"""
+		low = 0
+		high = len(self._chunks)
+		while low < high:
+			mid = (low + high) // 2
+			if self._last(mid) > pos:
+				high = mid
+			else:
+				low = mid + 1
+		return low
+
+	def add(self: "_LabelLevel", label: str, pos: int) -> None:
+		"""adds a position, after all equal ones"""
+		if not self._chunks:
+			self._chunks.append([pos])
+			self._names.append([label])
+			self._offsets.append(0)
+			return
+		chunk = min(self._find_chunk(pos), len(self._chunks) - 1)
+		positions = self._chunks[chunk]
+		index = bisect_right(positions, pos - self._offsets[chunk])
+		positions.insert(index, pos - self._offsets[chunk])
+		self._names[chunk].insert(index, label)
+		if len(positions) > 2 * self.CHUNK_SIZE:
+			self._chunks[chunk + 1: chunk + 1] = [positions[self.CHUNK_SIZE:]]
+			self._names[chunk + 1: chunk + 1] = [self._names[chunk][self.CHUNK_SIZE:]]
+			self._offsets.insert(chunk + 1, self._offsets[chunk])
+			del positions[self.CHUNK_SIZE:]
+			del self._names[chunk][self.CHUNK_SIZE:]
+
+	def __len__(self: "_LabelLevel") -> int:
+		return sum(map(len, self._chunks))
+
+	def items(self: "_LabelLevel") -> List[Tuple[str, int]]:
+		"""list of (label, position) sorted by position"""
+		return [
+			(label, pos + offset)
+			for positions, names, offset in zip(self._chunks, self._names, self._offsets)
+			for label, pos in zip(names, positions)
+		]
+
+	def get(self: "_LabelLevel", label: str) -> List[int]:
+		"""sorted list of the positions of label"""
+		return [
+			pos + offset
+			for positions, names, offset in zip(self._chunks, self._names, self._offsets)
+			for name, pos in zip(names, positions) if name == label
+		]
+
+	def dilate(self: "_LabelLevel", pos: int, value: int) -> None:
+		"""adds value to all positions greater than pos"""
+		if not self._chunks or self._last(-1) <= pos:
+			# no label after pos
+			return
+		chunk = self._find_chunk(pos)
+		positions = self._chunks[chunk]
+		index = bisect_right(positions, pos - self._offsets[chunk])
+		positions[index:] = [x + value for x in positions[index:]]
+		self._offsets[chunk + 1:] = [x + value for x in self._offsets[chunk + 1:]]
+		# deletions can move positions before previous ones
+		if value < 0:
+			if index > 0:
+				previous = positions[index - 1] + self._offsets[chunk]
+			elif chunk > 0:
+				previous = self._last(chunk - 1)
+			else:
+				return
+			if previous > positions[index] + self._offsets[chunk]:
+				self._sort()
+
+	def dilate_many(self: "_LabelLevel", dilatations: List[Tuple[int, int]]) -> None:
+		"""applies several dilatations (pos, value) sorted by pos,
+		all positions are relative to the string before any of them"""
+		items = self.items()
+		new_items = []
+		shift = 0
+		index = 0
+		for label, pos in items:
+			while index < len(dilatations) and dilatations[index][0] < pos:
+				shift += dilatations[index][1]
+				index += 1
+			new_items.append((label, pos + shift))
+		self._sort(new_items)
+
+	def _sort(self: "_LabelLevel", items: Optional[List[Tuple[str, int]]] = None) -> None:
+		"""sorts the positions again, keeping the order of equal ones
+		if items is given, it replaces the contents of the level"""
+		if items is None:
+			items = self.items()
+		items = sorted(items, key=lambda item: item[1])
+		self._chunks = [
+			[pos for _, pos in items[i:i + self.CHUNK_SIZE]]
+			for i in range(0, len(items), self.CHUNK_SIZE)
+		]
+		self._names = [
+			[label for label, _ in items[i:i + self.CHUNK_SIZE]]
+			for i in range(0, len(items), self.CHUNK_SIZE)
+		]
+		self._offsets = [0] * len(self._chunks)
+
+	def copy(self: "_LabelLevel") -> "_LabelLevel":
+		"""returns an independent copy of self"""
+		new = _LabelLevel()
+		new._chunks = [positions.copy() for positions in self._chunks]
+		new._names = [names.copy() for names in self._names]
+		new._offsets = self._offsets.copy()
+		return new
+
+
 class LabelStack:
 	"""a stack of labels,
 	each layer contains position relative
 	to the start of the current string being parsed"""
 
-	_stack: List[Dict[str, List[int]]]
+	_stack: List[_LabelLevel]
 
 	def __init__(self: "LabelStack") -> None:
 		"""initializes label stack"""
@@ -36,33 +170,38 @@ class LabelStack:
 		Preprocessor._recursion_depth"""
 		return len(self._stack)
 
+	@property
+	def size(self: "LabelStack") -> int:
+		"""The number of labels in all levels of the stack"""
+		return sum(map(len, self._stack))
+
 	@property
 	def top_level(self: "LabelStack") -> Dict[str, List[int]]:
 		"""Returns the top level of the stack"""
 		if self.height == 0:
 			raise EmptyLabelStack("Canno't access toplevel of an empty stack")
-		return self._stack[-1]
+		top_level = dict() # type: Dict[str, List[int]]
+		for label, pos in self._stack[-1].items():
+			top_level.setdefault(label, []).append(pos)
+		return top_level
 
 	def add_label(self: "LabelStack", label: str, pos: int) -> None:
 		"""Adds a label to the toplevel
 		pos should be relative to the string start (i.e. Position.relative_XXX)
 		"""
-		toplevel = self.top_level
-		if label in toplevel:
-			toplevel[label].append(pos)
-		else:
-			toplevel[label] = [pos]
+		if self.height == 0:
+			raise EmptyLabelStack("Canno't access toplevel of an empty stack")
+		self._stack[-1].add(label, pos)
 
 	def get_label(self: "LabelStack", label: str) -> List[int]:
-		"""returns a list of positions of label on the current level"""
-		toplevel = self.top_level
-		if label in toplevel:
-			return toplevel[label]
-		return []
+		"""returns the sorted list of positions of label on the current level"""
+		if self.height == 0:
+			raise EmptyLabelStack("Canno't access toplevel of an empty stack")
+		return self._stack[-1].get(label)
 
 	def new_level(self: "LabelStack") -> None:
 		"""Adds a new label level"""
-		self._stack.append(dict())
+		self._stack.append(_LabelLevel())
 
 	def pop_level(self: "LabelStack", offset: int) -> None:
 		"""Collapses a level
@@ -70,12 +209,8 @@ class LabelStack:
 		relative to the start of the previous one"""
 		if self.height < 2:
 			raise TooShortLabelStack("Label Stack height should be at least 2 to pop a level")
-		for label in self._stack[-1]:
-			offset_pos = [pos + offset for pos in self._stack[-1][label]]
-			if label in self._stack[-2]:
-				self._stack[-2][label].extend(offset_pos)
-			else:
-				self._stack[-2][label] = offset_pos
+		for label, pos in self._stack[-1].items():
+			self._stack[-2].add(label, pos + offset)
 		del self._stack[-1]
 
 	def forget_level(self: "LabelStack") -> None:
@@ -84,17 +219,6 @@ class LabelStack:
 			raise EmptyLabelStack("Canno't forget level on empty stack")
 		del self._stack[-1]
 
-	@staticmethod
-	def _dilate_list(lst: List[int], pos: int, value: int) -> List[int]:
-		"""returns the dilated list"""
-		new_list = []
-		for val in lst:
-			if val > pos:
-				new_list.append(val + value)
-			else:
-				new_list.append(val)
-		return new_list
-
 	def dilate_level(self: "LabelStack", level: int, pos: int, value: int) -> None:
 		"""dilates a level (used to signal an insertion/deletion)
 		level is the level to dilate (should be preprocessor._recursion_depth)
@@ -108,10 +232,22 @@ class LabelStack:
 			raise IndexError("height should be between {} and {}, got {}".format(
 				-self.height+1, self.height-1, level
 			))
-		new_level = dict()
-		for label in self._stack[level]:
-			new_level[label] = self._dilate_list(self._stack[level][label], pos, value)
-		self._stack[level] = new_level
+		if value != 0:
+			self._stack[level].dilate(pos, value)
+
+	def dilate_level_many(self: "LabelStack", level: int, dilatations: List[Tuple[int, int]]) -> None:
+		"""applies several dilatations to a level in a single pass
+		dilatations is a list of (pos, value) as in dilate_level, sorted by pos.
+		All positions are relative to the string before any of these dilatations
+		"""
+		if self.height == 0:
+			raise EmptyLabelStack("Cannot dilate level in empty stack")
+		if -self.height >= level or level >= self.height:
+			raise IndexError("height should be between {} and {}, got {}".format(
+				-self.height+1, self.height-1, level
+			))
+		if dilatations:
+			self._stack[level].dilate_many(dilatations)
 
 	def copy(self: "LabelStack") -> "LabelStack":
 		"""returns and independent copy of self"""
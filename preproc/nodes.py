@@ -0,0 +1,192 @@
+"""This module defines the tree produced by Preprocessor.compile
+
+It contains:
+
+- class TextNode
+	raw text between two tokens
+- class CommandNode
+	a "{% command args %}" pair, its children are the text and
+	nested commands found between the two tokens
+- class BlockNode(CommandNode)
+	a "{% block args %}...{% endblock %}" pair with its endblock already resolved
+- class UnmatchedNode
+	an unmatched begin or end token, reported when rendered
+- class BlockIndex
+	maps block starts to their matching endblock in a string
+- class Tree
+	the compiled string: source, tokens, top level nodes and block index
+
+All positions are relative to the start of the compiled string.
+"""
+
+from bisect import bisect_left
+from typing import Dict, List, Optional, Pattern, Tuple, Union
+
+from .defs import TokenMatch
+
+TokenList = List[Tuple[int, int, TokenMatch]]
+
+
+class TextNode:
+	"""raw text source[begin:end], copied as is in the output"""
+
+	begin: int
+	end: int
+
+	def __init__(self: "TextNode", begin: int, end: int) -> None:
+		self.begin = begin
+		self.end = end
+
+
+class CommandNode:
+	"""a command call, with positions matching Position:
+	#1{% #2cmd args#3 %}#4
+	- #1 - begin
+	- #2 - cmd_begin
+	- #3 - cmd_end
+	- #4 - end
+	children are the nodes between cmd_begin and cmd_end,
+	they are rendered before the command is called.
+	close_token is the index of the closing token in Tree.tokens"""
+
+	begin: int
+	cmd_begin: int
+	cmd_end: int
+	end: int
+	close_token: int
+	children: List["Node"]
+
+	def __init__(self: "CommandNode",
+		begin: int, cmd_begin: int, cmd_end: int, end: int,
+		close_token: int, children: List["Node"]
+	) -> None:
+		self.begin = begin
+		self.cmd_begin = cmd_begin
+		self.cmd_end = cmd_end
+		self.end = end
+		self.close_token = close_token
+		self.children = children
+
+
+class BlockNode(CommandNode):
+	"""a block call, same as CommandNode with the matching endblock position
+	...%}#4 contents #5{% endblock %}#6
+	- #5 - endblock_begin (-1 if no matching endblock was found)
+	- #6 - endblock_end
+	the block contents (source[end:endblock_begin]) are not compiled,
+	the block parses them itself if needed"""
+
+	endblock_begin: int
+	endblock_end: int
+
+	def __init__(self: "BlockNode",
+		begin: int, cmd_begin: int, cmd_end: int, end: int,
+		close_token: int, children: List["Node"],
+		endblock_begin: int, endblock_end: int
+	) -> None:
+		CommandNode.__init__(self, begin, cmd_begin, cmd_end, end, close_token, children)
+		self.endblock_begin = endblock_begin
+		self.endblock_end = endblock_end
+
+
+class UnmatchedNode:
+	"""an unmatched token at source[begin:end]
+	- unmatched CLOSE tokens raise an error as soon as they are reached
+	- unmatched OPEN tokens contain all following nodes as children,
+	  the error is raised once these are rendered"""
+
+	begin: int
+	end: int
+	token: TokenMatch
+	children: List["Node"]
+
+	def __init__(self: "UnmatchedNode",
+		begin: int, end: int, token: TokenMatch, children: List["Node"]
+	) -> None:
+		self.begin = begin
+		self.end = end
+		self.token = token
+		self.children = children
+
+
+Node = Union[TextNode, CommandNode, BlockNode, UnmatchedNode]
+
+
+class BlockIndex:
+	"""finds matching endblocks in source with a single pass per block name
+	For each (startblock, endblock) regex pair, all matches are listed once
+	and bracket-matched, so each lookup is a binary search.
+	The regexes depend on the tokens, so changing them builds a new entry."""
+
+	source: str
+	# (startblock, endblock) -> (event begins, event spans, matching end event)
+	# None if start and end matches overlap, the index can't be used then
+	_events: Dict[
+		Tuple[Pattern[str], Pattern[str]],
+		Optional[Tuple[List[int], List[Tuple[int, int]], List[int]]]
+	]
+
+	def __init__(self: "BlockIndex", source: str) -> None:
+		self.source = source
+		self._events = dict()
+
+	def _build(self: "BlockIndex", startblock: Pattern[str], endblock: Pattern[str]
+	) -> Optional[Tuple[List[int], List[Tuple[int, int]], List[int]]]:
+		"""lists and matches the startblock and endblock of source"""
+		events = [(match.start(), match.end(), 1) for match in startblock.finditer(self.source)]
+		events += [(match.start(), match.end(), -1) for match in endblock.finditer(self.source)]
+		events.sort()
+		for (_, previous_end, _), (begin, _, _) in zip(events, events[1:]):
+			if previous_end > begin:
+				return None
+		# matches[k] is the first end event closing a block opened before event k:
+		# the first j >= k such that depth[j+1] == depth[k] - 1
+		depth = [0]
+		for _, _, step in events:
+			depth.append(depth[-1] + step)
+		matches = [-1] * len(events)
+		first_at_depth: Dict[int, int] = dict()
+		for k in range(len(events) - 1, -1, -1):
+			first_at_depth[depth[k+1]] = k
+			matches[k] = first_at_depth.get(depth[k] - 1, -1)
+		return [x[0] for x in events], [(x[0], x[1]) for x in events], matches
+
+	def find(self: "BlockIndex", startblock: Pattern[str], endblock: Pattern[str], pos: int
+	) -> Optional[Tuple[int, int]]:
+		"""returns the position of the first endblock in source[pos:] that
+		doesn't match a startblock, (-1, -1) if there is none.
+		returns None if the index can't answer (overlapping tokens)"""
+		key = (startblock, endblock)
+		if key not in self._events:
+			self._events[key] = self._build(startblock, endblock)
+		events = self._events[key]
+		if events is None:
+			return None
+		begins, spans, matches = events
+		k = bisect_left(begins, pos)
+		if k > 0 and spans[k-1][1] > pos:
+			# a match straddles pos
+			return None
+		if k == len(matches) or matches[k] == -1:
+			return -1, -1
+		return spans[matches[k]]
+
+
+class Tree:
+	"""a compiled string, returned by Preprocessor.compile
+	and rendered by Preprocessor.render
+	- source: the compiled string
+	- tokens: the list of tokens found in source
+	- nodes: the top level nodes
+	- blocks: index of the endblocks in source"""
+
+	source: str
+	tokens: TokenList
+	nodes: List[Node]
+	blocks: BlockIndex
+
+	def __init__(self: "Tree", source: str, tokens: TokenList, nodes: List[Node]) -> None:
+		self.source = source
+		self.tokens = tokens
+		self.nodes = nodes
+		self.blocks = BlockIndex(source)
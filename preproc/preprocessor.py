@@ -2,20 +2,76 @@
 Definitions of the actual Preprocessor class
 """
 import re
+from bisect import bisect_left
+from collections import OrderedDict
+from os.path import isfile, join
 from sys import stderr
-from typing import Any, Callable, Dict, List, Tuple
+from typing import Any, Callable, Dict, List, Optional, Pattern, Tuple
 
 from .context import ContextStack, FileDescriptor
 from .defs import *
 from .errors import (ErrorMode, PreprocessorError, PreprocessorWarning,
                      WarningMode)
+from .files import FILE_CACHE, FileCache
 from .labels import LabelStack
+from .nodes import (BlockIndex, BlockNode, CommandNode, Node, TextNode,
+                    TokenList, Tree, UnmatchedNode)
+from .registry import Registry
 
-TokenList = List[Tuple[int, int, TokenMatch]]
 TypeCommand = Callable[["Preprocessor", str], str]
 TypeBlock = Callable[["Preprocessor", str, str], str]
 TypeFinalAction = Callable[["Preprocessor", str], str]
 
+# begin or end token
+REGEX_TOKENS = r"{begin}|{end}"
+# same but zero width, to find overlapping tokens like "{%}"
+REGEX_TOKENS_OVERLAPPING = r"(?=({begin}))(?=({end}))?|(?=({end}))"
+
+# static identifier followed by a nested command: "{% ident {% nested %} %}"
+REGEX_PREFIX_IDENTIFIER = re.compile(r"\s*({})[^_a-zA-Z0-9]".format(REGEX_IDENTIFIER))
+# identifier that could be extended by a nested command: "{% iden{% nested %} %}"
+REGEX_PREFIX_PARTIAL = re.compile(r"\s*(?:{})?".format(REGEX_IDENTIFIER))
+
+
+class _RenderFrame:
+	"""a command being rendered by Preprocessor.render
+	stores the output pieces of its children and the dilatation
+	at the time it was opened (to recover the position of its begin token)"""
+
+	node: Optional[Node]
+	nodes: List[Node]
+	index: int
+	pieces: List[str]
+	delta: int
+	begin: int
+	cmd_begin: int
+	cmd_end: int
+	end: int
+	close_token: int
+	endblock: Optional[Tuple[int, int]]
+	unmatched: bool
+
+	def __init__(self: "_RenderFrame", node: Optional[Node], nodes: List[Node], delta: int) -> None:
+		self.node = node
+		self.nodes = nodes
+		self.index = 0
+		self.pieces = []
+		self.delta = delta
+		self.endblock = None
+		self.unmatched = isinstance(node, UnmatchedNode)
+		if isinstance(node, UnmatchedNode):
+			self.begin = node.begin
+			self.cmd_begin = node.end
+		elif isinstance(node, CommandNode):
+			self.begin = node.begin
+			self.cmd_begin = node.cmd_begin
+			self.cmd_end = node.cmd_end
+			self.end = node.end
+			self.close_token = node.close_token
+			if isinstance(node, BlockNode):
+				self.endblock = (node.endblock_begin, node.endblock_end)
+
+
 class Preprocessor:
 	"""This class implements the preprocessor:
 
@@ -41,6 +97,14 @@ class Preprocessor:
       | AS_ERROR -> passes to self.send_error()
 	- use_color: bool (default False)
 	    if True, uses ansi color when priting errors
+	- call_cache_size: int (default 1024)
+	    number of pure command calls memoized, 0 disables memoization.
+	    call_cache_hits and call_cache_misses count lookups in that cache
+	- parallel_processes: int (default 0)
+	    number of processes used by for --parallel loops, 0 uses os.cpu_count()
+	- file_cache: FileCache (default FILE_CACHE)
+	    cache of the files read by include, shared by all preprocessors by default.
+	    file_cache.hits and file_cache.misses count lookups in that cache
 	"""
 
 	# constants
@@ -53,6 +117,9 @@ class Preprocessor:
 	safe_calls: bool = True
 	use_color: bool = False
 	string_delimiters: str = "\"'"
+	call_cache_size: int = 1024
+	parallel_processes: int = 0
+	file_cache: FileCache = FILE_CACHE
 
 	# warning and error modes
 	error_mode: ErrorMode = ErrorMode.RAISE
@@ -61,11 +128,17 @@ class Preprocessor:
 
 	# private attributes
 	_recursion_depth: int
+	_regex_cache: Dict[Tuple[str, str, str, str, str], Pattern[str]]
+	_call_cache: "OrderedDict[Tuple[Any, ...], Tuple[str, Dict[str, Dict[str, int]]]]"
+	_definitions_version: int
+	_side_effects: int
+	_warning_count: int
+	_found_files: Dict[Tuple[str, Tuple[str, ...]], Optional[str]]
 
 	# commands and blocks
-	commands: Dict[str, TypeCommand] = dict()
-	blocks: Dict[str, TypeBlock] = dict()
-	command_vars: Dict[str, Any] = dict()
+	commands: Registry[TypeCommand] = Registry()
+	blocks: Registry[TypeBlock] = Registry()
+	command_vars: Registry[Any] = Registry()
 	final_actions: List[TypeFinalAction] = []
 
 	# useful variables
@@ -73,17 +146,27 @@ class Preprocessor:
 	context: ContextStack
 	current_position: Position
 	include_path: List[str]
+	call_cache_hits: int
+	call_cache_misses: int
 
 
 	def __init__(self):
-		self.commands = Preprocessor.commands.copy()
-		self.blocks = Preprocessor.blocks.copy()
+		self.commands = Registry(Preprocessor.commands)
+		self.blocks = Registry(Preprocessor.blocks)
 		self.final_actions = Preprocessor.final_actions.copy()
-		self.command_vars = Preprocessor.command_vars.copy()
+		self.command_vars = Registry(Preprocessor.command_vars)
 		self.current_position = Position()
 		self.context = ContextStack()
 		self.labels = LabelStack()
 		self._recursion_depth = 0
+		self._regex_cache = dict()
+		self._call_cache = OrderedDict()
+		self._definitions_version = 0
+		self._side_effects = 0
+		self._warning_count = 0
+		self._found_files = dict()
+		self.call_cache_hits = 0
+		self.call_cache_misses = 0
 		self.include_path = list()
 		self.silent_warnings = Preprocessor.silent_warnings.copy()
 
@@ -120,6 +203,7 @@ class Preprocessor:
 		  | RAISE -> raise python warning
 		  | AS_ERROR -> passes to self.send_error()
 		"""
+		self._warning_count += 1
 		if name in self.silent_warnings:
 			return
 		warning = PreprocessorWarning(name, warning_msg, self.context)
@@ -130,6 +214,48 @@ class Preprocessor:
 		if self.warning_mode == WarningMode.AS_ERROR:
 			self.send_error("from-warning-"+name, warning_msg)
 
+	def define_many(self: "Preprocessor", defines: Dict[str, str]) -> None:
+		"""defines simple commands in bulk, like a "def <name> <value>" for
+		each item of defines (without parsing or stripping values)
+		raises ValueError if a name isn't a valid identifier"""
+		from .commands import define_macro # pylint: disable=import-outside-toplevel
+		for name, value in defines.items():
+			if not name.isidentifier():
+				raise ValueError("invalid define name \"{}\"".format(name))
+			define_macro(self, name, [], value)
+
+	def definitions_changed(self: "Preprocessor") -> None:
+		"""signals that commands or blocks were defined or undefined
+		invalidates the memoized results of pure commands,
+		call it after modifying self.commands or self.blocks directly"""
+		self._definitions_version += 1
+		self._call_cache.clear()
+
+	def find_file(self: "Preprocessor", path: str) -> Optional[str]:
+		"""returns path if it is a file, else the first join(include, path)
+		which is a file, with include in self.include_path
+		returns None if there is no such file.
+		results (None included) are cached by path and include_path
+		until the next call to process, or to forget_files"""
+		key = (path, tuple(self.include_path))
+		if key in self._found_files:
+			return self._found_files[key]
+		found = None
+		if isfile(path):
+			found = path
+		else:
+			for include in self.include_path:
+				if isfile(join(include, path)):
+					found = join(include, path)
+					break
+		self._found_files[key] = found
+		return found
+
+	def forget_files(self: "Preprocessor") -> None:
+		"""empties the cache of find_file,
+		call it when files are created or deleted while processing"""
+		self._found_files.clear()
+
 	def split_args(self: "Preprocessor", args: str) -> List[str]:
 		"""Splits args along space like on the command line
 		preserves strings
@@ -171,21 +297,70 @@ class Preprocessor:
 			arg_list.append(args[last_blank:ii].replace("\\ ", " "))
 		return arg_list
 
+	def _token_regex(self: "Preprocessor", regex: str, name: str = "") -> Pattern[str]:
+		"""compiles a regex depending on the current tokens
+		Inputs:
+			regex: str - the regex, with {begin}, {end}, {endblock} and {name}
+				placeholders replaced by the escaped token_begin, token_end,
+				token_endblock and name (other braces must be doubled)
+			name: str - the block or command name
+		Returns:
+			the compiled regex (with self.re_flags), cached on
+			(regex, token_begin, token_end, token_endblock, name)
+			so changing the tokens doesn't use stale patterns"""
+		key = (regex, self.token_begin, self.token_end, self.token_endblock, name)
+		pattern = self._regex_cache.get(key)
+		if pattern is None:
+			pattern = re.compile(regex.format(
+				begin=re.escape(self.token_begin), end=re.escape(self.token_end),
+				endblock=re.escape(self.token_endblock), name=re.escape(name)
+			), self.re_flags)
+			self._regex_cache[key] = pattern
+		return pattern
+
 	def _find_tokens(self: "Preprocessor", string: str) -> TokenList:
 		"""Find all tokens (begin/end) in string
 		Inputs:
 			string: str - the string to search for tokens
 		Returns:
 			tokens: List[int, TokenMatch] - list of (position, OPEN/CLOSE)
-				sorted by position (CLOSE comes first if equal)
+				sorted by position (OPEN comes first if equal)
 		"""
-		open_tokens  = re.finditer(re.escape(self.token_begin), string, self.re_flags)
-		close_tokens = re.finditer(re.escape(self.token_end), string, self.re_flags)
-		tokens = [(x.start(), x.end(), TokenMatch.OPEN) for x in open_tokens]
-		tokens += [(x.start(), x.end(), TokenMatch.CLOSE) for x in close_tokens]
-		# sort in order of appearance - if two tokens appear at same place
-		# sort CLOSE first
-		tokens.sort(key=lambda x: x[0] + 0.5 * int(x[2]))
+		if self.re_flags & re.IGNORECASE or any(
+			overlap in string for overlap in overlapping_tokens(self.token_begin, self.token_end)
+		):
+			return self._find_overlapping_tokens(string)
+		# tokens don't overlap: a single scan finds them in order
+		kinds = {self.token_begin: TokenMatch.OPEN, self.token_end: TokenMatch.CLOSE}
+		return [
+			(match.start(), match.end(), kinds[match.group()])
+			for match in self._token_regex(REGEX_TOKENS).finditer(string)
+		]
+
+	def _may_contain_tokens(self: "Preprocessor", string: str) -> bool:
+		"""quick check for tokens in string, without locating them
+		False means string contains no tokens and parsing would leave it unchanged"""
+		if self.re_flags & re.IGNORECASE:
+			return True
+		return self.token_begin in string or self.token_end in string
+
+	def _find_overlapping_tokens(self: "Preprocessor", string: str) -> TokenList:
+		"""same as _find_tokens, but supports tokens overlapping each other
+		(ex: "{%}" contains both "{%" and "%}")
+		tokens of the same type never overlap, as with re.finditer"""
+		tokens: TokenList = []
+		open_end = 0
+		close_end = 0
+		for match in self._token_regex(REGEX_TOKENS_OVERLAPPING).finditer(string):
+			start = match.start()
+			end = match.end(1)
+			if end != -1 and start >= open_end:
+				tokens.append((start, end, TokenMatch.OPEN))
+				open_end = end
+			end = match.end(2) if end != -1 else match.end(3)
+			if end != -1 and start >= close_end:
+				tokens.append((start, end, TokenMatch.CLOSE))
+				close_end = end
 		return tokens
 
 	@staticmethod
@@ -212,49 +387,51 @@ class Preprocessor:
 		return token_index
 
 	def _find_matching_endblock(
-		self: "Preprocessor", block_name: str, string: str
+		self: "Preprocessor", block_name: str, string: str, pos: int = 0,
+		index: Optional[BlockIndex] = None
 	) -> Tuple[int, int]:
 		"""Finds the matching endblock
-		i.e. the first enblock token in string that does not
+		i.e. the first enblock token in string[pos:] that does not
 		match a startblock token
 		Inputs:
 			block_name: str - the name of the block.
 				it is used to determine the endblock and startblock tokens
 			string: str - the string being parsed
+			pos: int - position to start searching from (default 0)
+			index: BlockIndex - index of string to use (default None)
 		Returns:
 			tuple(endblock_start_pos: int, endblock_end_pos: int)
+			relative to the start of string
 			(-1,-1) if no such endblock exists"""
-		endblock_regex = r"{}\s*{}{}\s*{}".format(
-			re.escape(self.token_begin), re.escape(self.token_endblock),
-			block_name, re.escape(self.token_end)
-		)
-		startblock_regex = r"{}\s*{}(?:{}|{})".format(
-			re.escape(self.token_begin), block_name,
-			re.escape(self.token_end), REGEX_IDENTIFIER_END
+		endblock_regex = self._token_regex(r"{begin}\s*{endblock}{name}\s*{end}", block_name)
+		startblock_regex = self._token_regex(
+			r"{begin}\s*{name}(?:{end}|" + REGEX_IDENTIFIER_END + ")", block_name
 		)
-		pos = 0
+		if index is not None:
+			found = index.find(startblock_regex, endblock_regex, pos)
+			if found is not None:
+				return found
 		open_block = 0
-		match_begin = re.search(startblock_regex, string, self.re_flags)
-		match_end = re.search(endblock_regex, string, self.re_flags)
+		match_begin = startblock_regex.search(string, pos)
+		match_end = endblock_regex.search(string, pos)
 		while True:
 			if match_end is None:
 				return -1, -1
-			if match_begin is None:
+			if match_begin is not None and match_begin.start() < match_end.start():
+				open_block += 1
+				pos = match_begin.end()
+				match_begin = startblock_regex.search(string, pos)
+				# the next endblock is unchanged unless it overlaps
+				if match_end.start() < pos:
+					match_end = endblock_regex.search(string, pos)
+			else:
 				open_block -= 1
 				if open_block == -1:
-					return pos + match_end.start(), pos + match_end.end()
-				pos += match_end.end()
-			else:
-				if match_begin.start() < match_end.start():
-					open_block += 1
-					pos += match_begin.end()
-				else:
-					open_block -= 1
-					if open_block == -1:
-						return pos + match_end.start(), pos + match_end.end()
-					pos += match_end.end()
-			match_begin = re.search(startblock_regex, string[pos:], self.re_flags)
-			match_end = re.search(endblock_regex, string[pos:], self.re_flags)
+					return match_end.start(), match_end.end()
+				pos = match_end.end()
+				match_end = endblock_regex.search(string, pos)
+				if match_begin is not None and match_begin.start() < pos:
+					match_begin = startblock_regex.search(string, pos)
 
 	def replace_string(self: "Preprocessor",
 		start: int, end: int, string: str, replacement: str, tokens: List[Tuple[int, int, Any]],
@@ -283,12 +460,31 @@ class Preprocessor:
 				if tokens[i][0] >= end:
 					tokens[i] = (tokens[i][0] + dilat, tokens[i][1] + dilat) + tokens[i][2:]
 				i += 1
+		self._dilate(start, end, dilat, pop_labels)
+		return string[:start] + replacement + string[end:]
+
+	def _dilate(self: "Preprocessor", start: int, end: int, dilat: int, pop_labels: bool = False) -> None:
+		"""signals that string[start:end] was replaced by a string
+		of length end - start + dilat:
+		adds the dilatation to the context and the current label level
+		if pop_labels, collapses the label level added by the replacement"""
 		self.context.add_dilatation(start+self.current_position.offset, dilat)
 		self.labels.dilate_level(self._recursion_depth, end, dilat)
 		# only remove level if it wasn't explicitly removed
 		if pop_labels and self.labels.height > self._recursion_depth + 1:
 			self.labels.pop_level(start)
-		return string[:start] + replacement + string[end:]
+
+	def _dilate_many(self: "Preprocessor", replacements: List[Tuple[int, int, int]]) -> None:
+		"""same as _dilate, for several replacements (start, end, dilat)
+		sorted by start and not overlapping, all positions are relative
+		to the string before any of them"""
+		shift = self.current_position.offset
+		for start, _, dilat in replacements:
+			self.context.add_dilatation(start + shift, dilat)
+			shift += dilat
+		self.labels.dilate_level_many(
+			self._recursion_depth, [(end, dilat) for _, end, dilat in replacements]
+		)
 
 	def safe_call(self: "Preprocessor", function, *args, **kwargs) -> str:
 		"""safely calls function (returning string)
@@ -308,6 +504,50 @@ class Preprocessor:
 			return string
 		return function(*args, **kwargs)
 
+	@staticmethod
+	def is_pure(function: Callable[..., str], args: str) -> bool:
+		"""checks whether calling the command or block function with args is pure:
+		it has no side effects and its result only depends on args,
+		the tokens and definitions, and the commands and blocks it calls.
+		functions declare it with a pure attribute, either a bool or
+		a function taking the argument string and returning a bool"""
+		pure = getattr(function, "pure", False)
+		if callable(pure):
+			return pure(args)
+		return pure is True
+
+	def _call_command(self: "Preprocessor", command: TypeCommand, args: str) -> str:
+		"""safely calls command with args, memoizing the results of pure calls
+		a call is only memoized if every command and block it runs is also pure
+		and it sends no warnings. Results are stored with the definitions
+		the call read, and reused only while these are unchanged"""
+		if not self.is_pure(command, args):
+			if getattr(command, "side_effects", True):
+				self._side_effects += 1
+			return self.safe_call(command, self, args)
+		if self.call_cache_size <= 0:
+			return self.safe_call(command, self, args)
+		key = (
+			command, args, self._definitions_version, self.token_begin, self.token_end,
+			self.token_endblock, self.re_flags, self._recursion_depth
+		)
+		cached = self._call_cache.get(key)
+		if cached is not None and self.up_to_date(cached[1]):
+			self._call_cache.move_to_end(key)
+			self.call_cache_hits += 1
+			# enclosing recordings depend on what the call would have read
+			self.replay_reads(cached[1])
+			return cached[0]
+		self.call_cache_misses += 1
+		side_effects = self._side_effects
+		warnings = self._warning_count
+		result, reads = self._record(self.safe_call, command, self, args)
+		if side_effects == self._side_effects and warnings == self._warning_count:
+			self._call_cache[key] = (result, reads)
+			if len(self._call_cache) > self.call_cache_size:
+				self._call_cache.popitem(last=False)
+		return result
+
 	def token_error(self: "Preprocessor", tokens: TokenList) -> None:
 		"""Raises an error for unmatched token on the first token in list"""
 		self.current_position.relative_begin = tokens[0][0]
@@ -325,11 +565,105 @@ class Preprocessor:
 			)
 		self.context.pop()
 
-	def parse(self: "Preprocessor", string: str) -> str:
-		"""parses the string, calling the command and blocks it contains
-		calls post_actions when parsing is done
+	@staticmethod
+	def _static_identifier(string: str, cmd_begin: int, cmd_end: int, children: List[Node]) -> Optional[str]:
+		"""returns the identifier of the command string[cmd_begin:cmd_end]
+		if it doesn't depend on the output of its children, None otherwise"""
+		for child in children:
+			if not isinstance(child, TextNode):
+				match = REGEX_PREFIX_IDENTIFIER.match(string, cmd_begin, child.begin)
+				if match is not None:
+					return match.group(1)
+				if REGEX_PREFIX_PARTIAL.fullmatch(string, cmd_begin, child.begin) is not None:
+					return None
+				return ""
+		return get_identifier_name(string[cmd_begin:cmd_end])[0]
+
+	def _compile_pair(self: "Preprocessor",
+		tree: Tree, open_index: int, close_index: int, children: List[Node]
+	) -> CommandNode:
+		"""returns the node for the pair tree.tokens[open_index], tree.tokens[close_index]
+		it is a BlockNode if its identifier is static and names a block"""
+		begin, cmd_begin, _ = tree.tokens[open_index]
+		cmd_end, end, _ = tree.tokens[close_index]
+		ident = self._static_identifier(tree.source, cmd_begin, cmd_end, children)
+		if ident is None or ident in self.commands or ident not in self.blocks:
+			return CommandNode(begin, cmd_begin, cmd_end, end, close_index, children)
+		endblock_b, endblock_e = self._find_matching_endblock(ident, tree.source, end, tree.blocks)
+		return BlockNode(begin, cmd_begin, cmd_end, end, close_index, children, endblock_b, endblock_e)
+
+	def _build_nodes(self: "Preprocessor",
+		tree: Tree, index: int, last: int, pending: int
+	) -> List[Tuple[List[Node], Optional[Tuple[int, int, int]]]]:
+		"""builds the nodes of tree.source[last:] from tree.tokens[index:]
+		pending is the number of commands left open by an interrupted render,
+		they are matched with closing tokens first.
+		Returns:
+			a list of pending + 1 tuple (nodes, close), going from the
+			innermost pending command to the top level.
+			close is (cmd_end, end, token_index) of the token closing the command
+			or None if it isn't closed"""
+		string = tree.source
+		tokens = tree.tokens
+		segments: List[Tuple[List[Node], Optional[Tuple[int, int, int]]]] = []
+		# stack of (open token index, children), -1 for top level and pending commands
+		stack: List[Tuple[int, List[Node]]] = [(-1, []) for _ in range(pending + 1)]
+		len_tokens = len(tokens)
+		len_string = len(string)
+		while index < len_tokens:
+			begin, end, token = tokens[index]
+			if begin > last:
+				stack[-1][1].append(TextNode(last, begin))
+			last = max(last, end)
+			if token == TokenMatch.OPEN:
+				stack.append((index, []))
+			elif len(stack) == 1:
+				stack[0][1].append(UnmatchedNode(begin, end, token, []))
+				last = len_string
+				break
+			else:
+				open_index, children = stack.pop()
+				if open_index == -1:
+					segments.append((children, (begin, end, index)))
+				else:
+					node = self._compile_pair(tree, open_index, index, children)
+					stack[-1][1].append(node)
+					if isinstance(node, BlockNode):
+						if node.endblock_begin == -1:
+							last = len_string
+							break
+						# skip tokens inside the block (tokens are sorted by start)
+						last = node.endblock_end
+						index = bisect_left(tokens, (last,), index + 1) - 1
+			index += 1
+		if last < len_string:
+			stack[-1][1].append(TextNode(last, len_string))
+		while len(stack) > 1:
+			open_index, children = stack.pop()
+			if open_index == -1:
+				segments.append((children, None))
+			else:
+				begin, end, token = tokens[open_index]
+				stack[-1][1].append(UnmatchedNode(begin, end, token, children))
+		segments.append((stack[0][1], None))
+		return segments
+
+	def compile(self: "Preprocessor", string: str) -> Tree:
+		"""tokenizes string into a tree of text, command and block nodes
+		blocks are resolved using the commands and blocks defined when compiling,
+		render checks them again and adapts if they where redefined since.
 		Inputs:
-			string - the string to parse
+			string - the string to compile
+		Returns:
+			a Tree, to render with self.render()"""
+		tree = Tree(string, self._find_tokens(string), [])
+		tree.nodes = self._build_nodes(tree, 0, 0, 0)[0][0]
+		return tree
+
+	def render(self: "Preprocessor", tree: Tree) -> str:
+		"""renders a compiled string, calling the command and blocks it contains
+		Inputs:
+			tree - the tree to render, returned by self.compile
 		Expects:
 			self._context[-1][0] should contain a context describing the string
 			self._context[-1][1] is used to determine offset between string and source
@@ -346,48 +680,66 @@ class Preprocessor:
 		# context init
 		self.current_position.offset = self.context.top.position
 
-		tokens: TokenList = self._find_tokens(string)
-
-		while len(tokens) > 1:  # needs two tokens to make a pair
-
-			# find innermost (nested pair)
-			if tokens[0][2] == TokenMatch.CLOSE:
-				self.token_error(tokens)
-			token_index = self._find_matching_pair(tokens)
-			if token_index == -1:
-				self.token_error(tokens)
+		string = tree.source
+		# total dilatation of the parts of string already rendered
+		delta = 0
+		stack = [_RenderFrame(None, tree.nodes, 0)]
 
-			self.current_position.relative_begin = tokens[token_index][0]
-			self.current_position.relative_cmd_begin = tokens[token_index][1]
-			self.current_position.relative_cmd_end = tokens[token_index+1][0]
-			self.current_position.relative_end = tokens[token_index+1][1]
-			substring = string[
-				self.current_position.relative_cmd_begin : self.current_position.relative_cmd_end
-			]
+		while True:
+			frame = stack[-1]
+			if frame.index < len(frame.nodes):
+				node = frame.nodes[frame.index]
+				frame.index += 1
+				if isinstance(node, TextNode):
+					frame.pieces.append(string[node.begin:node.end])
+				elif isinstance(node, UnmatchedNode) and node.token == TokenMatch.CLOSE:
+					self.token_error([(node.begin + delta, node.end + delta, node.token)])
+				else:
+					stack.append(_RenderFrame(node, node.children, delta))
+				continue
+			if len(stack) == 1:
+				break
+			del stack[-1]
+			if frame.unmatched:
+				# only report the outermost unmatched token
+				if not stack[-1].unmatched:
+					self.token_error([(frame.begin + frame.delta, frame.cmd_begin + frame.delta, TokenMatch.OPEN)])
+				continue
+
+			self.current_position.relative_begin = frame.begin + frame.delta
+			self.current_position.relative_cmd_begin = frame.cmd_begin + frame.delta
+			self.current_position.relative_cmd_end = frame.cmd_end + delta
+			self.current_position.relative_end = frame.end + delta
+			substring = "".join(frame.pieces)
 			ident, arg_string, i = get_identifier_name(substring)
 			self.current_position.relative_cmd_argbegin = i
 			end_pos = self.current_position.relative_end
 			self.context.update(self.current_position.begin)
 			new_str = ""
 			position = self.current_position.copy()
-			if ident in self.commands:
+			# set when the tree doesn't match the current commands and blocks
+			resume_at = -1
+			command = self.commands.get(ident)
+			if command is not None:
 				self.context.update(self.current_position.cmd_begin, "in command {}".format(ident))
-				command = self.commands[ident]
-				new_str = self.safe_call(command, self, arg_string)
+				new_str = self._call_command(command, arg_string)
 				self.context.pop()
+				if frame.endblock is not None:
+					resume_at = frame.end
 			elif ident in self.blocks:
-				endblock_b, endblock_e = self._find_matching_endblock(
-					ident, string[self.current_position.relative_end:]
-				)
+				# looked up again in case the tokens changed since compile
+				endblock_b, endblock_e = self._find_matching_endblock(ident, string, frame.end, tree.blocks)
+				if endblock_b != -1 and frame.endblock != (endblock_b, endblock_e):
+					resume_at = endblock_e
 				if endblock_b == -1:
 					self.send_error("unmatched-start-block", "no matching endblock for {} block.".format(ident))
-				self.current_position.endblock_begin = endblock_b + self.current_position.end
-				self.current_position.endblock_end = endblock_e + self.current_position.end
-				block_content = string[
-					self.current_position.relative_end : self.current_position.relative_endblock_begin
-				]
+				self.current_position.relative_endblock_begin = endblock_b + delta
+				self.current_position.relative_endblock_end = endblock_e + delta
+				block_content = string[frame.end : endblock_b]
 				end_pos = self.current_position.relative_endblock_end
 				block = self.blocks[ident]
+				if not self.is_pure(block, arg_string):
+					self._side_effects += 1
 
 				self.context.update(self.current_position.cmd_begin, "in block {}".format(ident))
 
@@ -405,17 +757,96 @@ class Preprocessor:
 						"undefined command or block: \"{}\".\nIt was ignored and left unchanged in output.".format(
 							ident
 					))
-				new_str = string[self.current_position.relative_begin : self.current_position.relative_end]
+				if frame.cmd_begin <= frame.cmd_end:
+					new_str = string[frame.begin : frame.cmd_begin] + substring + string[frame.cmd_end : frame.end]
+				else:
+					# overlapping begin and end tokens
+					new_str = string[frame.begin : frame.end]
+				if frame.endblock is not None:
+					resume_at = frame.end
 			self.current_position = position
 			self.context.pop()
-			string = self.replace_string(
-				self.current_position.relative_begin, end_pos, string, new_str, tokens, True
-			)
+			dilat = len(new_str) - (end_pos - self.current_position.relative_begin)
+			self._dilate(self.current_position.relative_begin, end_pos, dilat, True)
+			delta += dilat
+			stack[-1].pieces.append(new_str)
+			if resume_at != -1:
+				self._resume_render(tree, stack, frame.close_token + 1, resume_at)
 		# end while
-		if len(tokens) == 1:
-			self.token_error(tokens)
 		self._recursion_depth -= 1
-		return string
+		return "".join(stack[0].pieces)
+
+	def _resume_render(self: "Preprocessor",
+		tree: Tree, stack: List[_RenderFrame], index: int, last: int
+	) -> None:
+		"""rebuilds the nodes left to render in stack from tree.source[last:]
+		used when a command was compiled as a block or vice-versa
+		index is the index of the first token that can come after last"""
+		index = bisect_left(tree.tokens, (last,), index)
+		segments = self._build_nodes(tree, index, last, len(stack) - 1)
+		for frame, (nodes, close) in zip(reversed(stack), segments):
+			frame.nodes = nodes
+			frame.index = 0
+			if frame.node is not None:
+				# pending commands are compiled as commands
+				frame.endblock = None
+				frame.unmatched = close is None
+				if close is not None:
+					frame.cmd_end, frame.end, frame.close_token = close
+
+	def parse(self: "Preprocessor", string: str) -> str:
+		"""parses the string, calling the command and blocks it contains
+		same as self.render(self.compile(string))
+		Inputs:
+			string - the string to parse
+		Expects:
+			self._context[-1][0] should contain a context describing the string
+			self._context[-1][1] is used to determine offset between string and source
+			  (for error display)
+		Returns:
+			the resulting string"""
+		return self.render(self.compile(string))
+
+	def _registries(self: "Preprocessor") -> Dict[str, Registry]:
+		"""the registries of definitions, by attribute name"""
+		return {"commands": self.commands, "blocks": self.blocks, "command_vars": self.command_vars}
+
+	def parse_and_record(self: "Preprocessor", string: str) -> Tuple[str, Dict[str, Dict[str, int]]]:
+		"""same as self.parse(string), but also returns the definitions read
+		while parsing, including undefined names that were looked up
+		(by "if def", undefined commands...)
+		Returns:
+			(result, reads) where reads is
+			{"commands": {name: version}, "blocks": {...}, "command_vars": {...}}
+			with the version of each name when it was first read.
+			Use self.up_to_date(reads) to check none of them changed since"""
+		return self._record(self.parse, string)
+
+	def _record(self: "Preprocessor", function: Callable[..., str], *args: Any
+	) -> Tuple[str, Dict[str, Dict[str, int]]]:
+		"""returns function(*args) and the definitions it read, as parse_and_record"""
+		registries = self._registries()
+		recordings = {name: registry.start_recording() for name, registry in registries.items()}
+		try:
+			result = function(*args)
+		finally:
+			for name, registry in registries.items():
+				registry.stop_recording(recordings[name])
+		return result, recordings
+
+	def up_to_date(self: "Preprocessor", reads: Dict[str, Dict[str, int]]) -> bool:
+		"""checks that the definitions read by parse_and_record
+		all still have the version they were read with"""
+		registries = self._registries()
+		return all(registries[name].up_to_date(recording) for name, recording in reads.items())
+
+	def replay_reads(self: "Preprocessor", reads: Dict[str, Dict[str, int]]) -> None:
+		"""records the definitions read by parse_and_record as read again
+		call it when reusing its result instead of parsing again,
+		so that enclosing parse_and_record calls also depend on them"""
+		registries = self._registries()
+		for name, recording in reads.items():
+			registries[name].replay(recording)
 
 	def run_final_actions(self: "Preprocessor", string: str) -> str:
 		"""Runs all final actions"""
@@ -432,6 +863,7 @@ class Preprocessor:
 		- string: str -> the string to process
 		- filename: str -> the name of the file (used for error display)
 		Returns the processed string"""
+		self.forget_files()
 		self.context.new(FileDescriptor(filename, string), 0)
 		self.labels.new_level()
 		string = self.parse(string)
@@ -471,6 +903,9 @@ class Preprocessor:
 				  -d -D --define <name>[=<value>] defines a simple command
 				                       with name <name> which prints <value> (nothing if no value)
 				                       Can be used multiple times on command line
+				  --define-file <file> defines simple commands in bulk from a file, either
+				                       a JSON object {{"<name>": <value>}} or lines <name>[=<value>]
+				                       Can be used multiple times, --define takes precedence
 				  -i -I --include <path> Adds paths to the INCLUDE_PATH.
 					                     default INCLUDE_PATH is [".", dir(input_file), dir(output_file)]
 				                       Can be used multiple times on command line
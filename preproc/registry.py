@@ -0,0 +1,130 @@
+"""Module to implement definition registries
+- a registry is a dict of definitions (commands, blocks...) by name
+- each name has a version, which changes whenever it is defined or undefined
+- the names looked up can be recorded, with the version they had when read,
+  to know which definitions a rendering depends on"""
+
+from itertools import count
+from typing import Dict, List, Tuple, TypeVar
+
+Value = TypeVar("Value")
+
+# versions are unique in the process, a name defined again after restoring an
+# older copy of a registry never gets back a version used by another definition
+_VERSIONS = count(1)
+
+
+def version_mark() -> int:
+	"""returns a new version, no registry was modified between two marks
+	m1 and m2 if and only if m2 == m1 + 1"""
+	return next(_VERSIONS)
+
+
+class Registry(Dict[str, Value]):
+	"""a dict of definitions with a version per name
+	(0 for names unchanged since the registry was created)
+	lookups with in, [] and get are recorded in all active recordings.
+	copies keep the versions and share the recordings, so that
+	restoring a copy keeps track of the reads"""
+
+	_versions: Dict[str, int]
+	_recordings: List[Dict[str, int]]
+
+	def __init__(self: "Registry", *args, **kwargs) -> None:
+		super().__init__(*args, **kwargs)
+		self._versions = dict()
+		self._recordings = []
+
+	def version(self: "Registry", name: str) -> int:
+		"""returns the version of name"""
+		return self._versions.get(name, 0)
+
+	def _read(self: "Registry", name: str) -> None:
+		"""records a lookup of name"""
+		for recording in self._recordings:
+			if name not in recording:
+				recording[name] = self._versions.get(name, 0)
+
+	def touch(self: "Registry", name: str) -> None:
+		"""gives name a new version
+		use it when the definition of name is modified in place"""
+		self._versions[name] = next(_VERSIONS)
+
+	def __contains__(self: "Registry", name: object) -> bool:
+		if self._recordings:
+			self._read(name) # type: ignore
+		return super().__contains__(name)
+
+	def __getitem__(self: "Registry", name: str) -> Value:
+		if self._recordings:
+			self._read(name)
+		return super().__getitem__(name)
+
+	def get(self: "Registry", name: str, default=None):
+		if self._recordings:
+			self._read(name)
+		return super().get(name, default)
+
+	def __setitem__(self: "Registry", name: str, value: Value) -> None:
+		self.touch(name)
+		super().__setitem__(name, value)
+
+	def __delitem__(self: "Registry", name: str) -> None:
+		super().__delitem__(name)
+		self.touch(name)
+
+	def pop(self: "Registry", name: str, *default):
+		if super().__contains__(name):
+			self.touch(name)
+		return super().pop(name, *default)
+
+	def setdefault(self: "Registry", name: str, default=None):
+		if not super().__contains__(name):
+			self.touch(name)
+		return super().setdefault(name, default)
+
+	def update(self: "Registry", *args, **kwargs) -> None:
+		for name, value in dict(*args, **kwargs).items():
+			self[name] = value
+
+	def clear(self: "Registry") -> None:
+		for name in self:
+			self.touch(name)
+		super().clear()
+
+	def popitem(self: "Registry") -> Tuple[str, Value]:
+		name, value = super().popitem()
+		self.touch(name)
+		return name, value
+
+	def copy(self: "Registry") -> "Registry[Value]":
+		"""shallow copy, with the same versions and recordings"""
+		registry: Registry[Value] = Registry(self)
+		registry._versions = self._versions.copy()
+		registry._recordings = self._recordings
+		return registry
+
+	def start_recording(self: "Registry") -> Dict[str, int]:
+		"""starts recording lookups, returns the recording
+		it is filled with the names looked up and their version when first read
+		until stop_recording is called"""
+		recording: Dict[str, int] = dict()
+		self._recordings.append(recording)
+		return recording
+
+	def stop_recording(self: "Registry", recording: Dict[str, int]) -> None:
+		"""stops filling a recording returned by start_recording"""
+		for i, active in enumerate(self._recordings):
+			if active is recording:
+				del self._recordings[i]
+				return
+
+	def replay(self: "Registry", recording: Dict[str, int]) -> None:
+		"""records the names of a recording as read again, in all active recordings"""
+		if self._recordings:
+			for name in recording:
+				self._read(name)
+
+	def up_to_date(self: "Registry", recording: Dict[str, int]) -> bool:
+		"""checks that all names of a recording still have the version they were read with"""
+		return all(self._versions.get(name, 0) == version for name, version in recording.items())
@@ -0,0 +1,128 @@
+"""This module implements a rope, used to apply many replacements
+to a long string without copying it each time.
+
+It contains:
+
+- class Rope
+	a string stored as a balanced tree of pieces (treap)
+	- replace(start, end, text) costs O(log n) (n being the number of pieces)
+	- str(rope) builds the flat string
+"""
+
+from random import random
+from typing import List, Optional, Tuple
+
+
+class _Piece:
+	"""a node of the rope, represents source[begin:end]
+	length is the length of the whole subtree"""
+
+	source: str
+	begin: int
+	end: int
+	priority: float
+	length: int
+	left: Optional["_Piece"]
+	right: Optional["_Piece"]
+
+	def __init__(self: "_Piece", source: str, begin: int, end: int, priority: float) -> None:
+		self.source = source
+		self.begin = begin
+		self.end = end
+		self.priority = priority
+		self.length = end - begin
+		self.left = None
+		self.right = None
+
+	def update(self: "_Piece") -> None:
+		"""recomputes length from the children"""
+		self.length = self.end - self.begin
+		if self.left is not None:
+			self.length += self.left.length
+		if self.right is not None:
+			self.length += self.right.length
+
+
+def _split(node: Optional[_Piece], pos: int) -> Tuple[Optional[_Piece], Optional[_Piece]]:
+	"""splits node into two ropes, the first one containing the first pos characters"""
+	if node is None:
+		return None, None
+	left_len = node.left.length if node.left is not None else 0
+	if pos <= left_len:
+		left, node.left = _split(node.left, pos)
+		node.update()
+		return left, node
+	pos -= left_len
+	if pos >= node.end - node.begin:
+		node.right, right = _split(node.right, pos - node.end + node.begin)
+		node.update()
+		return node, right
+	# split inside the piece, the second half keeps
+	# the same priority to preserve the heap order
+	cut = node.begin + pos
+	second = _Piece(node.source, cut, node.end, node.priority)
+	second.right = node.right
+	second.update()
+	node.end = cut
+	node.right = None
+	node.update()
+	return node, second
+
+def _merge(left: Optional[_Piece], right: Optional[_Piece]) -> Optional[_Piece]:
+	"""concatenates two ropes"""
+	if left is None:
+		return right
+	if right is None:
+		return left
+	if left.priority > right.priority:
+		left.right = _merge(left.right, right)
+		left.update()
+		return left
+	right.left = _merge(left, right.left)
+	right.update()
+	return right
+
+
+class Rope:
+	"""a mutable string supporting fast replacements
+	ex: rope = Rope("hello world")
+	    rope.replace(0, 5, "goodbye")
+	    str(rope) -> "goodbye world"
+	"""
+
+	_root: Optional[_Piece]
+
+	def __init__(self: "Rope", string: str = "") -> None:
+		"""initializes a rope containing string"""
+		self._root = None
+		if string:
+			self._root = _Piece(string, 0, len(string), random())
+
+	def __len__(self: "Rope") -> int:
+		"""the length of the string"""
+		if self._root is None:
+			return 0
+		return self._root.length
+
+	def replace(self: "Rope", start: int, end: int, text: str) -> None:
+		"""replaces self[start:end] with text
+		same as string = string[:start] + text + string[end:]"""
+		left, right = _split(self._root, end)
+		left, _ = _split(left, start)
+		if text:
+			left = _merge(left, _Piece(text, 0, len(text), random()))
+		self._root = _merge(left, right)
+
+	def __str__(self: "Rope") -> str:
+		"""builds the flat string"""
+		pieces: List[str] = []
+		stack: List[_Piece] = []
+		node = self._root
+		while stack or node is not None:
+			while node is not None:
+				stack.append(node)
+				node = node.left
+			node = stack.pop()
+			pieces.append(node.source[node.begin:node.end])
+			node = node.right
+		return "".join(pieces)
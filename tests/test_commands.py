@@ -1,8 +1,11 @@
-from os import remove
+from os import mkdir, remove, rmdir
+from os.path import isfile, join
 
+import preproc.preprocessor as preprocessor_module
 from preproc import Preprocessor
-from preproc.blocks import find_elifs_and_else
-from preproc.errors import ErrorMode, WarningMode
+from preproc.blocks import find_branches, find_elifs_and_else
+from preproc.errors import ErrorMode, PreprocessorError, WarningMode
+from preproc.files import FILE_CACHE, FileCache
 
 
 class TestCommands:
@@ -40,9 +43,55 @@ class TestCommands:
 			("{% def add(a,b,c) (a+b+2c) %}hello{% add 1 2 3 %}", "hello(1+2+2c)"),
 			("{% def add(pha,alpha,lpha) (pha,alpha)lpha %}hello{% add 1 2 3 %}", "hello(1,2)3"),
 			("{% def f(a,b) a+b %}{% def f(a) {% f a 0 %} %}{% f 1 2 %}; {% f 1 %}", "1+2; 1+0"),
+			("{% def f(a,b) {% verbatim %}a{% b %}a{% endverbatim %} %}{% def q Q %}{% f 1 q %}{% f 2 q %}{% f 1 q %}", "1Q12Q21Q1"),
+			("{% def f(a) {% verbatim %}{% a %}{% endverbatim %} %}{% def x X %}{% f x %}{% def x Y %}{% f x %}", "XY"),
+			("{% def f(a0,a1,a2,a3,a4,a5,a6,a7,a8,a9) a9-a0 %}{% def f(a) a %}{% f 0 1 2 3 4 5 6 7 8 9 %}{% f x %}", "9-0x"),
 		]
 		self.runtests(test, "test_def")
 
+	def test_undef_overloads(self):
+		pre = Preprocessor()
+		assert pre.process("{% def f(a) x %}{% undef f %}{% def f(a,b) y %}{% f 1 2 %}", "test_undef") == "y"
+		assert list(pre.command_vars["def"]["f"]) == [2]
+		pre.process("{% undef f %}", "test_undef")
+		assert "f" not in pre.command_vars["def"]
+
+	def test_define_many(self):
+		pre = Preprocessor()
+		pre.define_many({"a": "A", "b": " {% a %} ", "c": ""})
+		assert pre.process("{% a %}{% b %}{% c %}", "test_define_many") == "A A "
+		pre.define_many({"a": "B"})
+		assert pre.process("{% b %}", "test_define_many") == " B "
+		try:
+			pre.define_many({"1a": "x"})
+			assert False
+		except ValueError:
+			pass
+
+	def test_memoization(self):
+		pre = Preprocessor()
+		test = "{% def f(a) a-{% call upper a %} %}{% f x %}{% f x %}{% f y %}"
+		assert pre.process(test, "test_memoization") == "x-Xx-Xy-Y"
+		assert pre.call_cache_hits == 1
+		# call upper a (in def), f x, upper x, f y, upper y
+		assert pre.call_cache_misses == 5
+		test = "{% f x %}{% def upper(a) U %}{% f x %}"
+		assert pre.process(test, "test_memoization") == "x-Xx-U"
+		test = (
+			"{% def g(a) {% call if def h %}H{% call else %}N{% call endif %} %}"
+			"{% def h %}{% g 1 %}{% undef h %}{% g 1 %}"
+		)
+		assert pre.process(test, "test_memoization") == "HN"
+		# loop commands are redefined at each iteration
+		test = "{% def show {% call i %} %}{% for i in range(3) %}[{% show %}{% def i fixed %}{% show %}]{% endfor %}"
+		assert pre.process(test, "test_memoization") == "[0fixed][1fixed][2fixed]"
+		# impure calls are never memoized
+		pre = Preprocessor()
+		pre.warning_mode = WarningMode.HIDE
+		test = "{% def f(a) a{% call label L %} %}{% f 1 %}{% f 1 %}{% atlabel L %}X{% endatlabel %}"
+		assert pre.process(test, "test_memoization") == "1X1X"
+		assert pre.call_cache_hits == 0
+
 	def test_begin_end(self):
 		test = [
 			("{% begin %}", "{%"),
@@ -85,6 +134,60 @@ class TestCommands:
 			self.single_runtest(in_str, "test_include", out_str)
 		remove(path)
 
+	def test_include_cache(self):
+		path = "test.out"
+		with open(path, "w") as file:
+			file.write("{% def a b %}hello")
+		cache = FileCache()
+		pre = Preprocessor()
+		pre.file_cache = cache
+		assert pre.process("{% include test.out %}{% include test.out %}{% a %}", "test_include_cache") == "hellohellob"
+		assert (cache.hits, cache.misses, len(cache)) == (1, 1, 1)
+		other = Preprocessor()
+		other.file_cache = cache
+		assert other.process("{% include -v test.out %}", "test_include_cache") == "{% def a b %}hello"
+		assert (cache.hits, cache.misses) == (2, 1)
+		assert cache.read(path, path)[1] is cache.read(path, path)[1]
+		with open(path, "w") as file:
+			file.write("changed")
+		assert pre.process("{% include test.out %}", "test_include_cache") == "changed"
+		assert (cache.hits, cache.misses) == (4, 2)
+		cache.clear()
+		assert (cache.hits, cache.misses, len(cache)) == (0, 0, 0)
+		remove(path)
+		assert Preprocessor().file_cache is FILE_CACHE
+
+	def test_include_path(self, monkeypatch):
+		folder = "test_include_dir"
+		mkdir(folder)
+		with open(join(folder, "a.out"), "w") as file:
+			file.write("a{% include b.out %}")
+		with open(join(folder, "b.out"), "w") as file:
+			file.write("b")
+		pre = Preprocessor()
+		pre.include_path = ["missing_dir"]
+		assert pre.process("{% include test_include_dir/a.out %}", "test_include_path") == "ab"
+		assert pre.include_path == ["missing_dir"]
+		try:
+			pre.process("{% include test_include_dir/a.out %}{% include b.out %}", "test_include_path")
+			assert False
+		except PreprocessorError as error:
+			assert error.name == "file-error"
+		calls = []
+		def counting_isfile(path):
+			calls.append(path)
+			return isfile(path)
+		monkeypatch.setattr(preprocessor_module, "isfile", counting_isfile)
+		pre.include_path.append(folder)
+		assert pre.process("{% include b.out %}" * 5, "test_include_path") == "bbbbb"
+		assert pre.find_file("missing.out") is None
+		assert pre.find_file("missing.out") is None
+		assert calls == ["b.out", "missing_dir/b.out", "test_include_dir/b.out",
+			"missing.out", "missing_dir/missing.out", "test_include_dir/missing.out"]
+		remove(join(folder, "a.out"))
+		remove(join(folder, "b.out"))
+		rmdir(folder)
+
 	def test_replace(self):
 		test = [
 			("foofoobjf{% replace foo bar %}oofbifooj", "barbarbjbarfbibarj"),
@@ -96,6 +199,7 @@ class TestCommands:
 			(r'{% replace -r "([a-z]+)" "low(\\1)" %}hello hio', "low(hello) low(hio)"),
 			("{% replace -c 2 foo bar %}foo foo foo foo", "bar bar foo foo"),
 			("{% replace foo bar \"foo yo bafoo\" %}", "bar yo babar"),
+			('{% replace -r "^" "> " %}ab\ncd', "> ab\n> cd"),
 		]
 		self.runtests(test, "test_replace")
 
@@ -121,10 +225,65 @@ class TestCommands:
 			 "a1b2c3d4"),
 			("{% deflist names alice john frank %}{% deflist ages 23 31 19 %}\n"
 			 "{% for i in range(3) %}{% names {% i %} %} (age {% ages {% i %} %})\n"
-	     "{% endfor %}", "\nalice (age 23)\njohn (age 31)\nfrank (age 19)\n")
+	     "{% endfor %}", "\nalice (age 23)\njohn (age 31)\nfrank (age 19)\n"),
+			("{% for x in range(3) %}{% x %}{% def x X %}{% x %}{% endfor %}{% x %}", "0X1X2XX"),
+			("{% for x in range(2) %}{% for x in a b %}{% x %}{% endfor %}{% x %}{% endfor %}", "abbabb"),
+			("{% for x in range(2) %}{% x %}{% block -b [ -e ] %}[x]{% endblock %}{% endfor %}", "0011"),
+			("{% deflist names alice john frank %}{% deflist ages 23 31 19 %}\n"
+			 "{% for name, age in zip(names, ages) %}{% name %} (age {% age %})\n"
+			 "{% endfor %}", "\nalice (age 23)\njohn (age 31)\nfrank (age 19)\n"),
+			("{% deflist a 1 2 3 %}{% deflist b x y %}{% for i, j in zip( a,b ) %}{% i %}{% j %};{% endfor %}{% i %}", "1x;2y;2"),
+			("{% deflist a 1 2 %}{% for i in zip(a) %}{% i %}{% deflist a 3 %}{% endfor %}{% a 0 %}", "123"),
 		]
 		self.runtests(test, "test_for_deflist")
 
+	def test_for_file(self):
+		files = [
+			("test.csv", 'name,age\nalice,23\n"bob, jr",31\n'),
+			("test.jsonl", '{"name": "alice", "age": 23}\n\n["x", 1, null]\n"plain"\n'),
+			("test.txt", "a\nb c\n"),
+		]
+		test = [
+			('{% for r in file("test.csv") %}[{% r %}|{% r name %}|{% r age %}]{% endfor %}',
+			 "[alice,23|alice|23][bob, jr,31|bob, jr|31]"),
+			("{% for name, age in file('test.csv') %}{% name %}={% age %};{% endfor %}", "alice=23;bob, jr=31;"),
+			("{% for r in file(test.jsonl) %}<{% r %}>{% endfor %}",
+			 '<{"name": "alice", "age": 23}><["x", 1, null]><"plain">'),
+			('{% for x in file("test.txt") %}{% for r in file("test.csv") %}{% x %}-{% r name %};{% endfor %}{% endfor %}',
+			 "a-alice;a-bob, jr;b c-alice;b c-bob, jr;"),
+			('{% for r in file("test.txt") %}{% r %}.{% endfor %}', "a.b c."),
+		]
+		for name, content in files:
+			with open(name, "w") as file:
+				file.write(content)
+		self.runtests(test, "test_for_file")
+		for name, _ in files:
+			remove(name)
+
+	def test_for_parallel(self):
+		# iterations with side effects, errors or warnings are rendered serially
+		test = [
+			"{% for x in range(300) %}{% x %},{% endfor %}{% x %}",
+			"{% def m(a) [a] %}{% for x in a b c %}{% m {% x %} %}{% endfor %}",
+			"{% for x in range(200) %}{% x %}{% def y {% x %} %}{% y %}{% endfor %}{% y %}",
+			"{% for x in range(200) %}{% x %}{% label foo %}{% endfor %}{% atlabel foo %}!{% endatlabel %}",
+			"{% for x in range(200) %}{% if {% x %} == 150 %}{% upper %}{% endif %}a{% endfor %}b",
+			"{% for x in range(200) %}{% if {% x %} == 150 %}{% cut %}{% x %}{% endcut %}{% endif %}{% paste %}{% endfor %}",
+			"{% for x in range(200) %}{% x hi %}{% endfor %}",
+			"{% atlabel A %}[]{% endatlabel %}x{% label A %}"
+			"{% for x in range(3) %}{% atlabel L{% x %} %}<{% x %}>{% endatlabel %}{% endfor %}"
+			"{% label L2 %}{% label L1 %}{% label L0 %}",
+		]
+		for i, in_str in enumerate(test):
+			print("============= test {} ==============".format(i))
+			serial = Preprocessor()
+			serial.warning_mode = WarningMode.HIDE
+			parallel = Preprocessor()
+			parallel.warning_mode = WarningMode.HIDE
+			parallel.parallel_processes = 2
+			assert parallel.process(in_str.replace("for x", "for --parallel x"), "test_for_parallel") == \
+				serial.process(in_str, "test_for_parallel")
+
 	def test_cut_paste(self):
 		test = [
 			("{% cut %}hello there!{% endcut %}hello:{% paste %}", "hello:hello there!"),
@@ -141,9 +300,34 @@ class TestCommands:
 	  	 "first paste: {% paste %}\n"
 	  	 "{% def foo notbar %}\n"
 	     "second paste: {% paste %}", "\n\nfirst paste: foo is bar\n\nsecond paste: foo is notbar"),
+			("{% def foo 1 %}{% cut b %}{% foo %}{% endcut %}{% cut a %}[{% paste b %}]{% endcut %}"
+			 "{% paste b %}{% paste a %}{% paste a %}{% def foo 2 %}{% paste a %}", "1[1][1][2]"),
+			("{% cut %}{% a %}{% endcut %}{% def a 1 %}{% paste %}{% cut %}{% a %}!{% endcut %}{% paste %}{% paste -f %}",
+			 "11!1!"),
+			("{% cut %}{% for x in a %}{% x %}{% endfor %}{% endcut %}{% def x 1 %}{% paste %}{% x %}", "aa"),
 		]
 		self.runtests(test, "test_cut_paste")
 
+	def test_paste_cache(self):
+		calls = []
+		def cmd_count(pre, args):
+			calls.append(args)
+			return str(len(calls))
+		cmd_count.pure = True
+		pre = Preprocessor()
+		pre.call_cache_size = 0
+		pre.commands["count"] = cmd_count
+		test = "{% cut %}{% count %}{% foo %}{% endcut %}{% def foo a %}{% paste %}{% paste %}{% paste --fresh %}{% paste %}"
+		assert pre.process(test, "test_paste_cache") == "1a1a2a2a"
+		assert pre.process("{% def foo b %}{% paste %}{% paste %}", "test_paste_cache") == "3b3b"
+		assert len(calls) == 3
+		# reads made by memoized calls are dependencies of the paste
+		test = (
+			"{% def x one %}{% def m {% call x %} %}{% cut a %}{% m %}{% endcut %}{% paste a %}|"
+			"{% cut %}{% m %}{% endcut %}{% paste %}|{% def x two %}{% paste %}|{% paste --fresh %}"
+		)
+		assert Preprocessor().process(test, "test_paste_cache") == "one|one|two|two"
+
 	def test_block(self):
 		test = [
 			("text{% void %}{% def name john %}hello this is a comment{% endvoid %}\n{% name %}", "text\njohn"),
@@ -161,6 +345,9 @@ class TestCommands:
 			("{% label a %}({% block -a %}{% label a %}{% atlabel a %}yo{% endatlabel %}{% endblock %})", "(yo)"),
 			("{% label a %}({% block -a %}{% label a %}{% atlabel a %}yo{% endatlabel %}{% endblock %}){% atlabel a %}boo{% endatlabel %}", "boo(booyo)"),
 			("{% label a %}({% block -al %}{% label a %}{% atlabel a %}yo{% endatlabel %}{% endblock %}){% atlabel a %}boo{% endatlabel %}", "boo(yo)"),
+			("{% label a %}{% label b %}x{% label a %}{% atlabel a %}A{% endatlabel %}{% atlabel b %}B{% endatlabel %}", "BAxA"),
+			("{% def bl verbatim %}{% {% bl %} %}{% foo %}{% endverbatim %}", "{% foo %}"),
+			("{% def verbatim v %}{% verbatim %}{% verbatim %}", "vv"),
 		]
 		self.runtests(test, "test_block")
 
@@ -189,5 +376,15 @@ class TestCommands:
 			("\n{% if ndef if %}\n\n{% elif ndef def %}\n\n{% elif def if %}{% line %}\n{% else %}kenobi{% endif %}", "\n6\n"),
 			("\n{% if ndef if %}\n\n{% elif ndef def %}some long test because reasons\n\n{% elif def if %}{% line %}\n{% else %}kenobi{% endif %}", "\n6\n"),
 			("""{% def foo bar %}{% if def foo %}{% if {% foo %}!=bar %}{% def foo si %}{% else %}{% def foo la %}{% endif %}{% else %}no foo{% endif %}{% foo %}""", "la"),
+			("{% if 0 %}a{% elif 0 %}b{% else %}c{% else %}d{% elif 1 %}e{% endif %}", "c"),
+			("{% if 1 %}a{% elif ( %}{% elif 1 %}{% endif %}", "a"),
+			("{% if 0 %}" + "".join("{{% elif {} == 7 %}}{}".format(i, i) for i in range(10)) + "{% endif %}", "7"),
 		]
 		self.runtests(test, "test_if")
+
+	def test_if_branches(self):
+		pre = Preprocessor()
+		string = "a{% elif x %}b{% if 1 %}{% else %}{% endif %}{% else %}c{% elif y"
+		branches, error = find_branches(pre, string)
+		assert branches == [(1, 13, (8, 11)), (45, 55, None)]
+		assert error == 56
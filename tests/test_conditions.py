@@ -1,5 +1,8 @@
 from preproc.conditions import *
+from preproc.conditions import _compiled_conditions
+from preproc.context import FileDescriptor
 from preproc.defaults import Preprocessor
+from preproc.errors import PreprocessorError
 
 
 def test_lexer():
@@ -28,3 +31,30 @@ def test_conditions():
 		for o_string, o_result in test:
 			assert condition_eval(preproc, string + " and " + o_string) == (result and o_result)
 			assert condition_eval(preproc, string + " or " + o_string) == (result or o_result)
+
+def test_condition_errors():
+	preproc = Preprocessor()
+	preproc.context.new(FileDescriptor("test_condition_errors", ""), 0)
+	test = [
+		("(true", "Unmatched \"(\""), ("true)", "Unmatched \")\""),
+		("true not false", "\"not\" must be preceeded"), ("a b", "simple conditions are"),
+	]
+	for string, message in test:
+		try:
+			condition_eval(preproc, string)
+			assert False
+		except PreprocessorError as error:
+			assert message in str(error)
+	# errors are only raised if the faulty part is evaluated
+	assert not condition_eval(preproc, "false and (true")
+	assert condition_eval(preproc, "true or a b")
+
+def test_compiled_conditions():
+	preproc = Preprocessor()
+	condition = compile_condition(condition_lexer("def foo or (a == b)"))
+	assert not condition(preproc)
+	preproc.commands["foo"] = lambda pre, args: ""
+	assert condition(preproc)
+	assert condition_eval(preproc, "ndef foo") is False
+	assert condition_eval(preproc, "ndef foo") is False
+	assert "ndef foo" in _compiled_conditions
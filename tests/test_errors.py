@@ -29,6 +29,12 @@ def test_error_preproc():
 		("{%", "unmatched-open-token", 1, 0),
 		("{% block %} {% if %} {% endblock %}", "unmatched-start-block", 1, 12),
 		("  %}", "unmatched-close-token", 1, 2),
+		("{% for x in range(3) %}\n {% x %}{% if {% x %} == 2 %}{% error %}{% endif %}{% endfor %}", "manual-error", 2, 32),
+		("{% for -p x in range(300) %}\n {% x %}{% if {% x %} == 200 %}{% error %}{% endif %}{% endfor %}", "manual-error", 2, 34),
+		("{% deflist l a %}{% for a, b in zip(l) %}{% endfor %}", "invalid-argument", 1, 19),
+		("{% def l a %}{% for a in zip(l) %}{% endfor %}", "invalid-argument", 1, 15),
+		("{% for a, b in x y %}{% endfor %}", "invalid-argument", 1, 2),
+		("{% for x in file(\"missing.csv\") %}{% endfor %}", "file-error", 1, 34),
 	]
 	for in_text, name, line, char in test_warning:
 		runtest_warning("test_error_preproc", in_text, name, line, char)
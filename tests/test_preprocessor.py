@@ -1,5 +1,12 @@
+import argparse
+
 from preproc import FileDescriptor, Preprocessor
-from preproc.defs import TokenMatch, get_identifier_name
+from preproc.arguments import ArgumentMatcher
+from preproc.defs import ArgumentParserNoExit, TokenMatch, get_identifier_name
+from preproc.dilatations import DilatationMap
+from preproc.labels import LabelStack
+from preproc.nodes import BlockIndex, BlockNode, CommandNode, TextNode, UnmatchedNode
+from preproc.registry import Registry
 
 
 def test_context():
@@ -14,6 +21,101 @@ and some unispired text"""
 	line, char = a.line_number(s.find("line"))
 	assert line == 2
 	assert char == 6
+	assert a.line_number(3) == (1, 3)
+	assert a.line_number(16) == (2, 0)
+	# line breaks are computed lazily and shared with the same file
+	b = FileDescriptor("", s)
+	assert b._line_breaks_list is None
+	assert b._line_breaks is a._line_breaks
+	assert FileDescriptor("other", s)._line_breaks is not a._line_breaks
+
+def test_dilatations():
+	dilatations = [(4, 3), (20, -5), (2, 6), (10, -2), (10, 4), (30, 7), (0, -1)]
+	dilatation_map = DilatationMap()
+	for i, (pos, value) in enumerate(dilatations):
+		dilatation_map = dilatation_map.add(pos, value)
+		for position in range(-5, 50):
+			expected = position
+			for dil_pos, dil_value in dilatations[i::-1]:
+				if dil_pos <= expected:
+					expected -= dil_value
+			assert dilatation_map.true_position(position) == expected
+
+def test_labels():
+	labels = LabelStack()
+	labels.new_level()
+	for label, pos in [("a", 2), ("b", 5), ("a", 9), ("a", 4)]:
+		labels.add_label(label, pos)
+	copy = labels.copy()
+	labels.dilate_level(0, 4, 10)
+	assert labels.get_label("a") == [2, 4, 19]
+	assert labels.get_label("b") == [15]
+	labels.dilate_level(0, 20, 3) # no labels after 20
+	labels.dilate_level(0, 3, -12)
+	assert labels.get_label("a") == [-8, 2, 7]
+	assert labels.get_label("b") == [3]
+	labels.new_level()
+	labels.add_label("b", 1)
+	labels.pop_level(10)
+	assert labels.get_label("b") == [3, 11]
+	labels.dilate_level_many(0, [(2, 1), (3, 5)])
+	assert labels.get_label("a") == [-8, 2, 13]
+	assert labels.get_label("b") == [4, 17]
+	assert copy.get_label("a") == [2, 4, 9]
+
+def test_registry():
+	registry = Registry({"a": 1})
+	assert registry.version("a") == 0
+	recording = registry.start_recording()
+	assert registry["a"] == 1
+	assert "b" not in registry
+	registry["a"] = 2
+	copy = registry.copy()
+	del registry["a"]
+	registry.stop_recording(recording)
+	assert registry.get("c") is None
+	assert recording == {"a": 0, "b": 0}
+	assert not registry.up_to_date(recording)
+	assert copy.up_to_date({"a": copy.version("a"), "b": 0})
+	assert copy.version("a") not in (0, registry.version("a"))
+
+def test_parse_and_record():
+	pre = Preprocessor()
+	pre.context.new(FileDescriptor("test_parse_and_record", ""), 0)
+	pre.labels.new_level()
+	pre.parse("{% def bar B %}")
+	result, reads = pre.parse_and_record("{% if def foo %}yes{% else %}{% bar %}{% endif %}")
+	assert result == "B"
+	assert "foo" in reads["commands"] and "foo" in reads["blocks"]
+	assert reads["commands"]["bar"] == pre.commands.version("bar")
+	assert pre.up_to_date(reads)
+	pre.parse("{% def baz %}")
+	assert pre.up_to_date(reads)
+	pre.parse("{% def foo %}")
+	assert not pre.up_to_date(reads)
+
+def test_argument_matcher():
+	parsers = (ArgumentParserNoExit(prog="test", add_help=False), ArgumentMatcher(prog="test"))
+	for parser in parsers:
+		parser.add_argument("--begin", "-b", nargs="?", default=None)
+		parser.add_argument("--local-defs", "-d", action="store_true")
+		parser.add_argument("--local-labels", "-l", action="store_true")
+		parser.add_argument("--count", "-c", nargs="?", default=0, type=int)
+		parser.add_argument("pattern")
+		parser.add_argument("text", nargs="?", default="")
+	tests = [
+		["a"], ["a", "b"], ["-dl", "a"], ["-b(", "a", "-c", "3"], ["--beg", "x", "a"],
+		["-b", "-d", "a"], ["--local", "a"], ["-c", "x", "a"], ["-1", "--", "-d"],
+		[], ["a", "b", "c"], ["-x", "a"], ["-d=1", "a"], ["--count=2", "a", "-l"],
+	]
+	for test in tests:
+		results = []
+		for parser in parsers:
+			try:
+				results.append(vars(parser.parse_args(test)))
+			except argparse.ArgumentError as error:
+				results.append(str(error))
+		assert results[0] == results[1]
 
 
 class TestPreProcMethods:
@@ -53,6 +155,14 @@ class TestPreProcMethods:
 		]
 		for test_in, test_out in tests:
 			assert self.pre._find_tokens(test_in) == test_out
+		# overlapping tokens
+		pre = Preprocessor()
+		assert pre._find_tokens("{%}{%%}") == [
+			(0,2, TokenMatch.OPEN),
+			(1,3, TokenMatch.CLOSE),
+			(3,5, TokenMatch.OPEN),
+			(5,7, TokenMatch.CLOSE),
+		]
 
 	def test_find_matching_pair(self):
 		"""Unit test for Preprovessor.find_matchin_pair"""
@@ -87,6 +197,37 @@ class TestPreProcMethods:
 		]
 		for arg0, arg1, rep in test:
 			assert self.pre._find_matching_endblock(arg0, arg1) == rep
+			assert self.pre._find_matching_endblock(arg0, arg1, 0, BlockIndex(arg1)) == rep
+		# searching from a position returns absolute positions
+		assert self.pre._find_matching_endblock("i", "(i) (ei) (ei)", 3) == (4, 8)
+		assert self.pre._find_matching_endblock("i", "(i) (ei) (ei)", 5) == (9, 13)
+
+	def test_token_regex(self):
+		pre = Preprocessor()
+		regex = pre._token_regex(r"{begin}\s*{name}", "foo")
+		assert pre._token_regex(r"{begin}\s*{name}", "foo") is regex
+		assert regex.match("{% foo") is not None
+		pre.token_begin = "(("
+		regex = pre._token_regex(r"{begin}\s*{name}", "foo")
+		assert regex.match("{% foo") is None
+		assert regex.match("((foo") is not None
+
+	def test_compile(self):
+		"""Unit test for Preprocessor.compile"""
+		pre = Preprocessor()
+		tree = pre.compile("a{% foo {% bar %} %}b{% if x %}{% c %}{% endif %}%}")
+		assert [type(node) for node in tree.nodes] == [
+			TextNode, CommandNode, TextNode, BlockNode, UnmatchedNode
+		]
+		command = tree.nodes[1]
+		assert (command.begin, command.cmd_begin, command.cmd_end, command.end) == (1, 3, 18, 20)
+		assert [type(node) for node in command.children] == [TextNode, CommandNode, TextNode]
+		block = tree.nodes[3]
+		assert (block.begin, block.end, block.endblock_begin, block.endblock_end) == (21, 31, 38, 49)
+		assert tree.nodes[4].token == TokenMatch.CLOSE
+		# dynamic identifiers are compiled as commands
+		tree = pre.compile("{% {% x %} %}{% endif %}")
+		assert [type(node) for node in tree.nodes] == [CommandNode, CommandNode]
 
 	def test_split_args(self):
 		test = [